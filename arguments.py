@@ -1,6 +1,18 @@
 import argparse
 
 
+def size(value: str) -> int:
+    # a byte count with an optional K/M/G suffix, e.g. 500K or 20M
+    units = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+    value = value.strip().lower().rstrip("b")
+    try:
+        if value and value[-1] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {value}")
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Downloads media from a subreddit")
     parser.description = "Downloads a given number of posts from a subreddit for offline viewing."
@@ -9,15 +21,17 @@ def parse_args():
     parser.add_argument(
         "-m",
         "--mode",
-        help="Mode to run in",
-        choices=["download", "list", "sync"],
+        help="Mode to run in (enqueue adds the comma-separated subreddits of --sub to the download queue, "
+             "run-queue downloads everything in it)",
+        choices=["download", "list", "sync", "enqueue", "run-queue"],
         default="list"
     )
 
     parser.add_argument(
         "--sub",
         "-s",
-        help="The subreddit to download or view from (no leading /r/)",
+        help="The subreddit to download or view from (no leading /r/), or a comma-separated list for download and "
+             "enqueue",
         type=str,
         default="all"
     )
@@ -30,6 +44,156 @@ def parse_args():
         help="The amount of posts to download"
     )
 
+    parser.add_argument(
+        "-I",
+        "--incremental",
+        action="store_true",
+        help="Stop downloading at the first post that was already downloaded",
+        default=False
+    )
+
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=4,
+        help="The amount of media files to download at the same time"
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="The amount of subreddits to download at the same time, each in its own process (download with "
+             "several subreddits, and run-queue)"
+    )
+
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=25,
+        help="The amount of posts to write to the database in a single transaction"
+    )
+
+    parser.add_argument(
+        "--skip-near-duplicates",
+        action="store_true",
+        help="Don't keep images that look the same as one that was already downloaded",
+        default=False
+    )
+
+    parser.add_argument(
+        "--phash-distance",
+        type=int,
+        default=6,
+        help="The most bits the perceptual hashes of two images can differ in for them to count as near-duplicates"
+    )
+
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=10,
+        help="The amount of connections to keep alive for each host"
+    )
+
+    parser.add_argument(
+        "--pool-hosts",
+        type=int,
+        default=10,
+        help="The amount of hosts to keep connection pools for"
+    )
+
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="The amount of times to retry a request that failed because of a connection or server error"
+    )
+
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=30,
+        help="The amount of seconds to wait for a server to respond"
+    )
+
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=0,
+        help="The most requests per second to send to a single host (0 to only follow the limits the host reports)"
+    )
+
+    parser.add_argument(
+        "--max-backoff",
+        type=float,
+        default=60,
+        help="The most seconds to wait before retrying a request that was rate limited"
+    )
+
+    parser.add_argument(
+        "--max-bandwidth",
+        type=size,
+        default=0,
+        help="The most bytes per second to download, for all downloads together, e.g. 5M (0 for unlimited)"
+    )
+
+    parser.add_argument(
+        "--large-file-threshold",
+        type=size,
+        default="20M",
+        help="Files at least this big are downloaded on their own lane. The size of videos is checked with a HEAD "
+             "request first (0 to download everything in listing order)"
+    )
+
+    parser.add_argument(
+        "--large-workers",
+        type=int,
+        default=1,
+        help="The amount of large files to download at the same time"
+    )
+
+    parser.add_argument(
+        "--max-video-height",
+        type=int,
+        default=0,
+        help="Download reddit videos in the best rendition at most this tall, e.g. 480 (0 for the best one)"
+    )
+
+    parser.add_argument(
+        "--max-video-bitrate",
+        type=int,
+        default=0,
+        help="Download reddit videos in the best rendition with at most this bitrate in kbps (0 for the best one)"
+    )
+
+    parser.add_argument(
+        "--handler-cache-ttl",
+        type=float,
+        default=7,
+        help="How many days to remember the media URLs found on imgur and gfycat pages (0 to keep them forever)"
+    )
+
+    parser.add_argument(
+        "--thumbnail-cache-size",
+        type=size,
+        default="512M",
+        help="The most disk space the thumbnails of the web UI can take up (0 for no limit)"
+    )
+
+    parser.add_argument(
+        "--pregenerate-thumbnails",
+        action="store_true",
+        help="Make the thumbnails of the web UI in the background while downloading, instead of on the first visit"
+    )
+
+    parser.add_argument(
+        "--thumbnail-workers",
+        type=int,
+        default=0,
+        help="The amount of processes that make thumbnails with --pregenerate-thumbnails "
+             "(0 for one per CPU, less the extra --processes)"
+    )
+
     parser.add_argument(
         "-L",
         "--log-level",
@@ -111,6 +275,20 @@ def parse_args():
         help="Reset the database and filesystem",
     )
 
+    parser.add_argument(
+        "--reddit-url",
+        type=str,
+        default="https://www.reddit.com",
+        help="The reddit to download from (for testing against a local server)"
+    )
+
+    parser.add_argument(
+        "--data-dir",
+        type=str,
+        default=None,
+        help="The directory to keep the database and media files in, instead of the default one for your platform"
+    )
+
     parser.add_argument(
         "-S",
         "--server",
@@ -0,0 +1,150 @@
+# Benchmarks for the download pipeline, run entirely against the local fake reddit in fake_reddit.py, so they work
+# offline and give comparable numbers between runs.
+#
+# usage: python benchmark.py [--posts 1000] [--latency 0.02] [--bandwidth 10M] [-- <extra reddit-dl arguments>]
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import fake_reddit
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks the download pipeline against a fake reddit")
+    parser.add_argument("--posts", type=int, default=500, help="The amount of posts to download")
+    parser.add_argument("--image-size", type=fake_reddit.parse_size, default="200K", help="The size of image files")
+    parser.add_argument("--video-size", type=fake_reddit.parse_size, default="2M", help="The size of 720p videos")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds the server waits before answering")
+    parser.add_argument("--bandwidth", type=fake_reddit.parse_size, default="0",
+                        help="Bytes per second per connection (0 for unlimited)")
+    parser.add_argument("--duplicate-every", type=int, default=0, help="Every nth post reuses the previous media")
+    parser.add_argument("--throttle-every", type=int, default=0, help="The server answers every nth request with 429")
+    parser.add_argument("--repeat", type=int, default=1, help="How many times to run each benchmark")
+    parser.add_argument("--only", choices=["download", "resolve", "media"], action="append",
+                        help="Only run the given benchmarks")
+    parser.add_argument("--json", action="store_true", help="Print the results as json")
+    parser.add_argument("extra", nargs="*", help="Extra arguments for reddit-dl (after --)")
+    return parser.parse_args()
+
+
+class Result:
+    def __init__(self, name: str, seconds: float, counters: dict, timings: dict):
+        self.name = name
+        self.seconds = seconds
+        self.posts = counters.pop("posts", 0)
+        self.files = counters.pop("files", 0)
+        self.transferred = counters.pop("bytes", 0)
+        self.counters = counters
+        self.timings = timings
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "seconds": self.seconds,
+            "posts": self.posts,
+            "files": self.files,
+            "bytes": self.transferred,
+            "posts_per_second": self.posts / self.seconds if self.seconds else 0,
+            "mb_per_second": self.transferred / 1024 ** 2 / self.seconds if self.seconds else 0,
+            "counters": self.counters,
+            "timings": self.timings,
+        }
+
+    def __str__(self):
+        d = self.as_dict()
+        res = (
+            f"{self.name}: {self.seconds:.2f}s, {self.posts} posts, {self.files} files, "
+            f"{d['posts_per_second']:.1f} posts/s, {d['mb_per_second']:.2f} MB/s"
+        )
+        for counter, value in sorted(self.counters.items()):
+            res += f"\n    {counter:<16} {value:8d}"
+        for stage, seconds in sorted(self.timings.items()):
+            res += f"\n    {stage:<16} {seconds:8.3f}s"
+        return res
+
+
+def measure(name: str, func) -> Result:
+    import log
+    log.stats.reset()
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    return Result(name, seconds, dict(log.stats.counters), dict(log.stats.timings))
+
+
+def main():
+    a = parse_args()
+    fake = fake_reddit.FakeReddit(
+        posts=a.posts, image_size=a.image_size, video_size=a.video_size, latency=a.latency, bandwidth=a.bandwidth,
+        duplicate_every=a.duplicate_every, throttle_every=a.throttle_every
+    )
+    server = fake_reddit.start(fake)
+    data_dir = tempfile.mkdtemp(prefix="reddit-dl-bench-")
+
+    # imgur links are plain http, so they can be proxied to the fake server
+    os.environ["HTTP_PROXY"] = os.environ["http_proxy"] = fake.base_url
+    os.environ["NO_PROXY"] = os.environ["no_proxy"] = "127.0.0.1,localhost"
+    # reddit-dl reads its arguments when it is imported
+    sys.argv = [
+        "main.py", "--reddit-url", fake.base_url, "--data-dir", data_dir, "--limit", str(a.posts), "-L", "error",
+        *a.extra
+    ]
+
+    import main as reddit_dl
+    import log
+    import utils
+    utils.setup(tools=False)
+
+    def bench_download(run: int):
+        reddit_dl.download(f"bench{run}", a.posts)
+
+    def bench_resolve(run: int):
+        # resolve every post of a listing from scratch, without the caches
+        reddit_dl.resolve_url.cache_clear()
+        reddit_dl.cur.execute("DELETE FROM `resolved_urls`")
+        for post in reddit_dl.iter_posts(f"resolve{run}", a.posts):
+            log.stats.add("posts")
+            with log.stats.timer("resolve_all"):
+                reddit_dl.get_media_url(post)
+
+    def bench_media(run: int):
+        # download media files one after another, to measure a single transfer
+        target = os.path.join(data_dir, f"media-{run}")
+        os.mkdir(target)
+        for i in range(min(a.posts, 50)):
+            log.stats.add("posts")
+            log.progress.request_progress(f"{fake.base_url}/media/bench{run}-{i}.jpg",
+                                          os.path.join(target, str(i)), "", True)
+            log.stats.add("files")
+
+    benchmarks = {"download": bench_download, "resolve": bench_resolve, "media": bench_media}
+    results = []
+    try:
+        for name, func in benchmarks.items():
+            if a.only and name not in a.only:
+                continue
+            for run in range(a.repeat):
+                results.append(measure(name, lambda: func(run)))
+    finally:
+        server.shutdown()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    if a.json:
+        print(json.dumps({
+            "results": [r.as_dict() for r in results],
+            "server": {"requests": fake.requests, "throttled": fake.throttled, "bytes": fake.bytes_sent},
+        }, indent=2))
+    else:
+        for r in results:
+            print(r)
+        print(
+            f"server: {fake.requests} requests, {fake.throttled} throttled, {fake.bytes_sent / 1024 ** 2:.1f} MB sent"
+        )
+
+
+if __name__ == "__main__":
+    main()
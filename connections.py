@@ -0,0 +1,84 @@
+# Connections to data.db. Every connection uses WAL journal mode, so readers (like the web UI) don't wait for a
+# download that is writing and the writer doesn't wait for them, and the pool lets the threads of the server reuse
+# connections (and their prepared statements) instead of connecting on every request.
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# how long to wait for another connection's write lock before giving up, in seconds
+BUSY_TIMEOUT = 30
+# the amount of prepared statements each connection keeps around
+STATEMENT_CACHE_SIZE = 256
+# the page cache of each connection, in KiB
+CACHE_SIZE = 64 * 1024
+# how much of the database file to memory-map, in bytes
+MMAP_SIZE = 256 * 1024 ** 2
+# the most idle connections the pool keeps open
+POOL_SIZE = 8
+
+
+def connect(path: str, check_same_thread: bool = True) -> sqlite3.Connection:
+    """
+    Opens a tuned connection to a database.
+    :param path: The path of the database.
+    :param check_same_thread: Whether only the thread that opened the connection can use it.
+    :return: The connection.
+    """
+    connection = sqlite3.connect(
+        path, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=check_same_thread
+    )
+    connection.execute("PRAGMA journal_mode = WAL")
+    # with WAL, NORMAL can only lose the last commits on a power failure, and never corrupts the database
+    connection.execute("PRAGMA synchronous = NORMAL")
+    connection.execute(f"PRAGMA cache_size = -{CACHE_SIZE}")
+    connection.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    return connection
+
+
+def remove(path: str):
+    """
+    Deletes a database along with its WAL and shared memory files. Every connection to it has to be closed first.
+    :param path: The path of the database.
+    """
+    for file in (path, path + "-wal", path + "-shm"):
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+
+
+class ConnectionPool:
+    """
+    A pool of connections to a database. A thread checks a connection out for as long as it needs it, so no two
+    threads ever use the same connection at the same time.
+    """
+    def __init__(self, path: str, size: int = POOL_SIZE):
+        self.path = path
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self) -> sqlite3.Connection:
+        with self.lock:
+            connection = self.idle.pop() if self.idle else None
+        if connection is None:
+            connection = connect(self.path, check_same_thread=False)
+        try:
+            yield connection
+        finally:
+            if connection.in_transaction:
+                connection.rollback()  # don't hand out a connection that is holding a lock
+            with self.lock:
+                if len(self.idle) < self.size:
+                    self.idle.append(connection)
+                    connection = None
+            if connection is not None:
+                connection.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
@@ -1,8 +1,8 @@
 import os
-import sqlite3
 import sys
 
 import arguments
+import connections
 import errors
 import blessed
 
@@ -60,13 +60,30 @@ term = blessed.Terminal()
 
 HALF = '\N{LOWER HALF BLOCK}'
 
+# the most posts the reddit json api returns in one listing page
+LISTING_PAGE_SIZE = 100
+
+# how many media downloads can be queued or running per download worker before the listing waits for them
+IN_FLIGHT_PER_WORKER = 4
+
+# how many resolved special handler and cross-post URLs to keep in memory
+RESOLVE_CACHE_SIZE = 1024
+
+# how many bits perceptual hashes can differ in by default for two images to count as near-duplicates
+PHASH_DISTANCE = args.phash_distance
+
 USERAGENT = {"User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:99.0) Gecko/20100101 Firefox/99.0"}
 
 # set a constant for the platform
 PLATFORM = sys.platform
 
+# where to get posts from, can be pointed at a local server (see fake_reddit.py) for testing
+REDDIT_URL = args.reddit_url.rstrip("/")
+
 # get the application data directory (operating system independent)
-if PLATFORM == 'linux':
+if args.data_dir:
+    DATA_DIR = os.path.join(os.path.expanduser(args.data_dir), '')
+elif PLATFORM == 'linux':
     DATA_DIR = os.path.expanduser('~/.local/share/reddit-dl/')
 elif PLATFORM == 'win32':
     DATA_DIR = os.path.expanduser('~/AppData/Local/reddit-dl/')
@@ -91,6 +108,6 @@ if not os.path.exists(DATA_DIR + 'ffplay'):
         pass
 
 logger.debug("Connecting to database")
-db = sqlite3.connect(DATA_DIR + "data.db")
+db = connections.connect(DATA_DIR + "data.db")
 logger.debug("Database connection established")
 cur = db.cursor()
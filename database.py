@@ -0,0 +1,289 @@
+# Helpers for writing to the database efficiently.
+import sqlite3
+import time
+
+import log
+import phash
+from constants import logger
+
+# download states that don't need the download to be tried again
+FINISHED_STATES = ("complete", "near-duplicate")
+
+# sqlite can't take more than 999 parameters in a query on older versions
+MAX_PARAMETERS = 999
+
+# the columns of a post, in the order main.Post and server.post_json expect them
+# (queries name them instead of using SELECT *, so migrations can add columns)
+POST_COLUMN_NAMES = (
+    "id", "title", "link", "generated_md5", "author", "time", "type", "file_url", "is_video", "nsfw", "spoiler",
+    "score", "vote_ratio", "subreddit", "path"
+)
+POST_COLUMNS = ", ".join(f"`{column}`" for column in POST_COLUMN_NAMES)
+
+
+class PostWriter:
+    """
+    Collects posts and inserts them into the database in batches, with one transaction (and one fsync) per batch
+    instead of one per post.
+    """
+    def __init__(self, connection: sqlite3.Connection, batch_size: int = 25):
+        self.db = connection
+        self.cur = connection.cursor()
+        self.batch_size = max(batch_size, 1)
+        self.pending = []
+        self.downloads = []
+        self.blobs = []
+        self.phashes = []
+        self.resolved = []
+        self.sync_state = []
+        self.icons = []
+        # the posts that were already handed out for downloading
+        self.submitted = set()
+
+    def add(self, post) -> list:
+        """
+        Queues a post for the posts table, writing the batch if it is full.
+        :param post: The post to insert (a main.Post).
+        :return: The posts whose media needs to be downloaded, if the batch was written.
+        """
+        self.pending.append(post)
+        if len(self.pending) >= self.batch_size:
+            return self.flush()
+        return []
+
+    def record_download(self, post_id: str, state: str, size: int = 0, digest: str = None):
+        """
+        Queues an update of the download state of a post, which is written with the next batch.
+        :param post_id: The id of the post.
+        :param state: The new state ('pending', 'complete', 'near-duplicate' or 'failed').
+        :param size: The amount of bytes on disk.
+        :param digest: The hash of the file in the media store.
+        """
+        self.downloads.append((state, size, digest, post_id))
+
+    def record_blob(self, url: str, digest: str, size: int):
+        """
+        Queues a file that was added to the media store, and the URL it came from.
+        :param url: The URL of the file.
+        :param digest: The hash of the file.
+        :param size: The size of the file.
+        """
+        self.blobs.append((url, digest, size))
+
+    def record_phash(self, post_id: str, h: int):
+        """
+        Queues the perceptual hash of the image of a post.
+        :param post_id: The id of the post.
+        :param h: The 64-bit hash.
+        """
+        self.phashes.append((post_id, phash.to_signed(h)))
+
+    def record_resolved(self, url: str, resolved: str):
+        """
+        Queues a special handler or cross-post URL that was resolved to a media URL.
+        :param url: The URL.
+        :param resolved: The URL of the media, or an empty string if there is none.
+        """
+        self.resolved.append((url, resolved, int(time.time())))
+
+    def record_sync_state(self, subreddit: str, name: str, created: int):
+        """
+        Queues the newest post of a subreddit, where the next incremental download stops.
+        :param subreddit: The subreddit.
+        :param name: The fullname of the post.
+        :param created: The creation time of the post.
+        """
+        self.sync_state.append((subreddit, name, created))
+
+    def record_icon(self, subreddit: str, state: str):
+        """
+        Queues whether a subreddit's icon was downloaded, for the subreddits table.
+        :param subreddit: The subreddit.
+        :param state: 'present', or 'none' if the subreddit has no icon.
+        """
+        self.icons.append((subreddit, state))
+
+    def post_path(self, post_id: str) -> str or None:
+        """
+        Gets the path of the media file of a post.
+        :param post_id: The id of the post.
+        :return: The path, or None if the post isn't in the database.
+        """
+        self.cur.execute("SELECT `path` FROM `posts` WHERE `id` = ?", (post_id,))
+        row = self.cur.fetchone()
+        return row[0] if row else None
+
+    def known_blob(self, url: str) -> tuple[str, int] or None:
+        """
+        Looks up the file a URL pointed to the last time it was downloaded.
+        :param url: The URL.
+        :return: The hash and size of the file, or None if the URL was never downloaded.
+        """
+        self.cur.execute("SELECT `hash`, `size` FROM `blob_urls` WHERE `url` = ?", (url,))
+        return self.cur.fetchone()
+
+    def existing(self, ids: list[str]) -> dict[str, str or None]:
+        """
+        Checks which post ids are already in the database.
+        :param ids: The post ids to check.
+        :return: The ids that are in the database, mapped to the state of their download (None if unknown).
+        """
+        found = {}
+        for i in range(0, len(ids), MAX_PARAMETERS):
+            chunk = ids[i:i + MAX_PARAMETERS]
+            self.cur.execute(
+                "SELECT `posts`.`id`, `downloads`.`state` FROM `posts` "
+                "LEFT JOIN `downloads` ON `downloads`.`post_id` = `posts`.`id` "
+                "WHERE `posts`.`id` IN (%s)" % ", ".join("?" * len(chunk)),
+                chunk
+            )
+            found.update(self.cur.fetchall())
+        return found
+
+    def take_batch(self) -> tuple[dict, list]:
+        """
+        Takes everything that is queued, skipping posts that are already in the database.
+        :return: The batch to write (plain rows, so it can be sent to another process), and the posts whose media
+        needs to be downloaded: new posts, and old ones whose download never finished.
+        """
+        posts, self.pending = self.pending, []
+        existing = self.existing([post.id for post in posts])
+        new = []
+        unfinished = []
+        for post in posts:
+            if post.id in self.submitted:
+                continue  # the same post can show up twice if the listing shifts between pages
+            self.submitted.add(post.id)
+            if post.id not in existing:
+                new.append(post)
+            elif existing[post.id] not in FINISHED_STATES:
+                logger.debug(f"Post {post.id} already exists in database, resuming its download")
+                unfinished.append(post)
+            else:
+                logger.debug(f"Post {post.id} already exists in database")
+
+        batch = {
+            "posts": [post.row() for post in new],
+            "pending": [(post.id,) for post in new + unfinished],
+            "downloads": self.downloads,
+            "blobs": self.blobs,
+            "phashes": self.phashes,
+            "resolved": self.resolved,
+            "sync_state": self.sync_state,
+            "icons": self.icons,
+        }
+        self.downloads, self.blobs, self.phashes, self.resolved, self.sync_state, self.icons = [], [], [], [], [], []
+        return batch, new + unfinished
+
+    @log.stats.timer("database")
+    def write(self, batch: dict):
+        """
+        Writes a batch in a single transaction.
+        :param batch: The batch, from take_batch.
+        """
+        with self.db:
+            self.cur.executemany(
+                f'INSERT OR IGNORE INTO `posts` ({POST_COLUMNS}, `shuffle_key`) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, RANDOM())',
+                batch["posts"]
+            )
+            self.cur.executemany("INSERT OR IGNORE INTO `downloads` VALUES (?, 'pending', 0, NULL)", batch["pending"])
+            self.cur.executemany(
+                "UPDATE `downloads` SET `state` = ?, `size` = ?, `hash` = ? WHERE `post_id` = ?",
+                batch["downloads"]
+            )
+            self.cur.executemany(
+                "INSERT OR IGNORE INTO `blobs` VALUES (?, ?)",
+                [(digest, size) for _, digest, size in batch["blobs"]]
+            )
+            self.cur.executemany("INSERT OR REPLACE INTO `blob_urls` VALUES (?, ?, ?)", batch["blobs"])
+            self.cur.executemany("INSERT OR REPLACE INTO `phashes` VALUES (?, ?)", batch["phashes"])
+            self.cur.executemany("INSERT OR REPLACE INTO `resolved_urls` VALUES (?, ?, ?)", batch["resolved"])
+            self.cur.executemany("INSERT OR REPLACE INTO `sync_state` VALUES (?, ?, ?)", batch["sync_state"])
+            self.cur.executemany(
+                "INSERT INTO `subreddits` (`name`, `icon`) VALUES (?, ?) "
+                "ON CONFLICT (`name`) DO UPDATE SET `icon` = excluded.`icon`",
+                batch["icons"]
+            )
+
+    def flush(self) -> list:
+        """
+        Writes all the queued posts and download states in a single transaction. Posts that are already in the
+        database are skipped, without aborting the rest of the batch.
+        :return: The posts whose media needs to be downloaded.
+        """
+        queued = (self.pending, self.downloads, self.blobs, self.phashes, self.resolved, self.sync_state, self.icons)
+        if not any(queued):
+            return []
+        batch, posts = self.take_batch()
+        self.write(batch)
+        return posts
+
+    def close(self) -> list:
+        """
+        Writes whatever is left and commits any other pending changes.
+        :return: The posts whose media needs to be downloaded.
+        """
+        posts = self.flush()
+        self.db.commit()
+        return posts
+
+
+class QueueWriter(PostWriter):
+    """
+    The writer of the worker processes of a sharded download. It reads from the database directly, but sends its
+    batches to the coordinating process, which writes them with the only writing connection, so the processes don't
+    fight over the database lock.
+    """
+    def __init__(self, connection: sqlite3.Connection, queue, batch_size: int = 25):
+        super().__init__(connection, batch_size)
+        self.queue = queue
+
+    def write(self, batch: dict):
+        self.queue.put(batch)
+
+    def close(self) -> list:
+        return self.flush()
+
+
+def search_posts(cur: sqlite3.Cursor, text: str, subreddit: str = None, limit: int = 25, offset: int = 0) -> list:
+    """
+    Searches the titles, authors and subreddits of posts. Every word has to match the start of a word in the post.
+    :param cur: The database cursor.
+    :param text: The words to search for.
+    :param subreddit: Only search this subreddit.
+    :param limit: The most posts to return.
+    :param offset: The amount of posts to skip.
+    :return: The rows of the posts, best match first.
+    """
+    words = text.split()
+    if not words:
+        return []
+    cur.execute("SELECT 1 FROM `sqlite_master` WHERE `name` = 'posts_fts'")
+    if cur.fetchone() is None:
+        # no full-text index (sqlite without fts5), so fall back to scanning the table
+        where = ["(`title` LIKE ? OR `author` LIKE ? OR `subreddit` LIKE ?)"] * len(words)
+        params = [f"%{word}%" for word in words for _ in range(3)]
+        if subreddit:
+            where.append("`subreddit` = ?")
+            params.append(subreddit)
+        cur.execute(
+            f"SELECT {POST_COLUMNS} FROM `posts` WHERE " + " AND ".join(where) +
+            " ORDER BY `time` DESC LIMIT ? OFFSET ?",
+            params + [limit, offset]
+        )
+        return cur.fetchall()
+
+    # quote every word so nothing in it is read as query syntax, and match it as a prefix
+    query = " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+    columns = ", ".join(f"`posts`.`{column}`" for column in POST_COLUMN_NAMES)
+    sql = (
+        f"SELECT {columns} FROM `posts_fts` JOIN `posts` ON `posts`.`rowid` = `posts_fts`.`rowid` "
+        "WHERE `posts_fts` MATCH ?"
+    )
+    params = [query]
+    if subreddit:
+        sql += " AND `posts`.`subreddit` = ?"
+        params.append(subreddit)
+    cur.execute(sql + " ORDER BY `posts_fts`.`rank` LIMIT ? OFFSET ?", params + [limit, offset])
+    return cur.fetchall()
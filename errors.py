@@ -6,3 +6,15 @@ class UnsupportedPlatformError(Exception):
 
     def __str__(self):
         return self.message.format(self.platform)
+
+
+class SchemaTooNewError(Exception):
+    def __init__(self, version, known, message="The database has schema version {}, but this version only knows {}. "
+                                               "Please update reddit-dl."):
+        self.version = version
+        self.known = known
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return self.message.format(self.version, self.known)
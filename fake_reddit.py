@@ -0,0 +1,400 @@
+# A local stand-in for reddit and the media hosts it links to, for measuring the downloader without the internet.
+# It serves synthetic listings, cross-posts, imgur/gfycat pages and media files, with configurable latency and
+# bandwidth, and can pretend to rate limit like reddit does.
+#
+# imgur and gfycat links in the listings use plain http, so pointing HTTP_PROXY at this server makes it answer for
+# those hosts too (the server handles proxy-style requests with absolute URLs).
+import argparse
+import hashlib
+import io
+import json
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+CHUNK_SIZE = 16 * 1024
+
+
+def base36(number: int) -> str:
+    chars = "0123456789abcdefghijklmnopqrstuvwxyz"
+    res = ""
+    while True:
+        number, i = divmod(number, 36)
+        res = chars[i] + res
+        if number == 0:
+            return res
+
+
+def parse_size(size: str) -> int:
+    """
+    Parses a human readable size like 512K or 10M.
+    :param size: The size.
+    :return: The amount of bytes.
+    """
+    units = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([KMG]?)B?", str(size).strip().upper())
+    if not match:
+        raise ValueError(f"Invalid size: {size}")
+    return int(float(match.group(1)) * units[match.group(2)])
+
+
+class FakeReddit:
+    """
+    The content and behaviour of the fake server.
+    """
+    def __init__(self, posts: int = 1000, image_size: int = 200 * 1024, video_size: int = 2 * 1024 ** 2,
+                 latency: float = 0.0, bandwidth: int = 0, duplicate_every: int = 0, ratelimit_budget: int = 0,
+                 ratelimit_window: float = 600, throttle_every: int = 0):
+        """
+        :param posts: The amount of posts in every subreddit.
+        :param image_size: The size of image files.
+        :param video_size: The size of video files.
+        :param latency: The seconds to wait before answering any request.
+        :param bandwidth: The bytes per second to send response bodies at (0 for unlimited).
+        :param duplicate_every: Every nth post reuses the media of the post before it (0 to disable).
+        :param ratelimit_budget: The requests per window allowed to listing and json endpoints (0 for unlimited).
+        :param ratelimit_window: The length of the rate limit window in seconds.
+        :param throttle_every: Answer every nth request with 429, no matter the budget (0 to disable).
+        """
+        self.posts = posts
+        self.image_size = image_size
+        self.video_size = video_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.duplicate_every = duplicate_every
+        self.ratelimit_budget = ratelimit_budget
+        self.ratelimit_window = ratelimit_window
+        self.throttle_every = throttle_every
+        self.base_url = ""
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.bytes_sent = 0
+        self.window_start = time.monotonic()
+        self.window_used = 0
+
+    # the content
+
+    def kind(self, index: int) -> str:
+        if index % 50 == 49:
+            return "self"
+        if index % 25 == 24:
+            return "imgur"
+        if index % 20 == 19:
+            return "crosspost"
+        if index % 10 == 9:
+            return "video"
+        return "image"
+
+    def media_index(self, index: int) -> int:
+        if self.duplicate_every and index % self.duplicate_every == self.duplicate_every - 1 and index > 0:
+            return index - 1
+        return index
+
+    @staticmethod
+    def id_offset(subreddit: str) -> int:
+        # post ids are unique across subreddits, like on reddit
+        return 36 ** 4 + zlib.crc32(subreddit.lower().encode()) % 1000 * 10 ** 6
+
+    def post_index(self, subreddit: str, post_id: str) -> int:
+        return int(post_id, 36) - self.id_offset(subreddit)
+
+    def post(self, subreddit: str, index: int) -> dict:
+        post_id = base36(index + self.id_offset(subreddit))
+        kind = self.kind(index)
+        media_id = base36(self.media_index(index) + 36 ** 4)
+        post = {
+            "id": post_id,
+            "name": "t3_" + post_id,
+            "title": f"Post {index} of {subreddit}",
+            "permalink": f"/r/{subreddit}/comments/{post_id}/post_{index}/",
+            "author": f"user{index % 97}",
+            "subreddit": subreddit,
+            "created_utc": 1650000000 - index * 60,
+            "is_video": False,
+            "media": None,
+            "over_18": index % 13 == 0,
+            "spoiler": index % 17 == 0,
+            "stickied": False,
+            "score": (index * 7919) % 10000,
+            "upvote_ratio": 0.5 + (index % 50) / 100,
+            "all_awardings": [{"name": "Silver", "count": 1}] * 5,
+            "url": f"{self.base_url}/media/{media_id}.jpg",
+        }
+        if kind == "self":
+            post["url"] = post["permalink"]
+        elif kind == "imgur":
+            post["url"] = f"http://imgur.com/gallery/g{media_id}x"  # imgur ids have 5 to 7 characters
+        elif kind == "crosspost":
+            post["url"] = f"{self.base_url}/r/{subreddit}/comments/{post_id}/crosspost"
+        elif kind == "video":
+            post["is_video"] = True
+            post["url"] = f"{self.base_url}/video/{media_id}"
+            post["media"] = {"reddit_video": {
+                "fallback_url": f"{self.base_url}/video/{media_id}/DASH_720.mp4?source=fallback",
+                "dash_url": f"{self.base_url}/video/{media_id}/DASHPlaylist.mpd",
+                "hls_url": f"{self.base_url}/video/{media_id}/HLSPlaylist.m3u8",
+                "height": 720,
+                "width": 1280,
+                "bitrate_kbps": 2400,
+            }}
+        return post
+
+    def listing(self, subreddit: str, query: dict) -> dict:
+        limit = min(int(query.get("limit", ["25"])[0]), 100)
+        after = query.get("after", [None])[0]
+        start = self.post_index(subreddit, after[3:]) + 1 if after else 0
+        end = min(start + limit, self.posts)
+        children = [{"kind": "t3", "data": self.post(subreddit, i)} for i in range(start, end)]
+        return {"kind": "Listing", "data": {
+            "after": children[-1]["data"]["name"] if children and end < self.posts else None,
+            "children": children,
+        }}
+
+    def blob(self, name: str, size: int) -> bytes:
+        # deterministic, so the same name always has the same content
+        seed = hashlib.sha256(name.encode()).digest()
+        return (seed * (size // len(seed) + 1))[:size]
+
+    def image(self, name: str, size: int) -> bytes:
+        """
+        A real (if boring) JPEG, padded to the requested size, so the images can be decoded and hashed.
+        Decoders ignore everything after the end of the image.
+        """
+        try:
+            from PIL import Image
+        except ImportError:
+            return self.blob(name, size)
+        seed = hashlib.sha256(name.encode()).digest()
+        im = Image.new("RGB", (64, 64), tuple(seed[:3]))
+        for i in range(8):
+            x, y = seed[3 + i] % 48, seed[11 + i] % 48
+            im.paste(tuple(seed[19 + i:22 + i]), (x, y, x + 16, y + 16))
+        out = io.BytesIO()
+        im.resize((512, 512)).save(out, format="JPEG", quality=85)
+        data = out.getvalue()
+        return data + self.blob(name, max(size - len(data), 0))
+
+    def video_sizes(self) -> dict:
+        return {240: self.video_size // 6, 360: self.video_size // 4, 480: self.video_size // 2,
+                720: self.video_size, 1080: self.video_size * 2}
+
+    def dash_manifest(self, media_id: str) -> str:
+        representations = "".join(
+            f'<Representation id="{height}" height="{height}" width="{height * 16 // 9}" '
+            f'bandwidth="{size * 8 // 10}"><BaseURL>DASH_{height}.mp4</BaseURL></Representation>'
+            for height, size in self.video_sizes().items()
+        )
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<MPD xmlns="urn:mpeg:dash:schema:mpd:2011"><Period><AdaptationSet contentType="video">'
+            f'{representations}</AdaptationSet><AdaptationSet contentType="audio"><Representation id="audio" '
+            'bandwidth="128000"><BaseURL>DASH_audio.mp4</BaseURL></Representation></AdaptationSet></Period></MPD>'
+        )
+
+    # the behaviour
+
+    def check_rate_limit(self) -> tuple[bool, dict]:
+        """
+        Counts a rate limited request.
+        :return: Whether the request is allowed, and the headers to send with it.
+        """
+        with self.lock:
+            if self.throttle_every and self.requests % self.throttle_every == 0:
+                self.throttled += 1
+                return False, {"Retry-After": "1"}
+            if not self.ratelimit_budget:
+                return True, {}
+            now = time.monotonic()
+            if now - self.window_start >= self.ratelimit_window:
+                self.window_start = now
+                self.window_used = 0
+            self.window_used += 1
+            reset = self.ratelimit_window - (now - self.window_start)
+            headers = {
+                "X-Ratelimit-Used": str(self.window_used),
+                "X-Ratelimit-Remaining": str(max(self.ratelimit_budget - self.window_used, 0)),
+                "X-Ratelimit-Reset": str(int(reset)),
+            }
+            if self.window_used > self.ratelimit_budget:
+                self.throttled += 1
+                return False, headers
+            return True, headers
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = "FakeReddit/1.0"
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def fake(self) -> FakeReddit:
+        return self.server.fake
+
+    def handle(self):
+        try:
+            super().handle()
+        except (ConnectionResetError, BrokenPipeError):
+            pass  # the client hung up, which run_handler does on purpose when it has read enough of a page
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.handle_request(head=True)
+
+    def do_GET(self):
+        self.handle_request(head=False)
+
+    def handle_request(self, head: bool):
+        fake = self.fake
+        with fake.lock:
+            fake.requests += 1
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        url = urlparse(self.path)
+        host = url.netloc or "local"  # proxy requests have absolute urls
+        path = url.path
+        query = parse_qs(url.query)
+
+        if host.endswith("imgur.com") and host.startswith("i."):
+            return self.send_blob(path, fake.image_size, "image/jpeg", head, image=True)
+        if host.endswith("imgur.com"):
+            media_id = path.rstrip("/").split("/")[-1]
+            return self.send_body(
+                f'<html><head><meta property="og:image" content="http://i.imgur.com/{media_id}.jpg"></head>'
+                f'<body>{"<div></div>" * 2000}</body></html>'.encode(),
+                "text/html", head
+            )
+
+        if path.startswith("/media/"):
+            return self.send_blob(path, fake.image_size, "image/jpeg", head, image=True)
+        if path.startswith("/icon/"):
+            return self.send_blob(path, 4096, "image/png", head)
+
+        match = re.fullmatch(r"/video/(\w+)/DASH_(\d+)\.mp4", path)
+        if match:
+            size = fake.video_sizes().get(int(match.group(2)))
+            if size is None:
+                return self.send_error(404)
+            return self.send_blob(path, size, "video/mp4", head)
+        match = re.fullmatch(r"/video/(\w+)/DASHPlaylist\.mpd", path)
+        if match:
+            return self.send_body(fake.dash_manifest(match.group(1)).encode(), "application/dash+xml", head)
+
+        # everything below is reddit's json api, which is rate limited
+        allowed, headers = fake.check_rate_limit()
+        if not allowed:
+            return self.send_body(b'{"message": "Too Many Requests", "error": 429}', "application/json", head,
+                                  status=429, headers=headers)
+
+        # the posts are made in time order, so the hot and new listings are the same
+        match = re.fullmatch(r"/r/(\w+)(?:/new)?\.json", path)
+        if match:
+            if match.group(1).startswith("missing"):
+                self.send_response(302)
+                self.send_header("Location", f"/subreddits/search.json?q={match.group(1)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            return self.send_json(fake.listing(match.group(1), query), head, headers)
+        match = re.fullmatch(r"/subreddits/search\.json", path)
+        if match:
+            return self.send_json({"kind": "Listing", "data": {"after": None, "children": []}}, head, headers)
+        match = re.fullmatch(r"/r/(\w+)/about\.json", path)
+        if match:
+            return self.send_json({"kind": "t5", "data": {
+                "community_icon": f"{fake.base_url}/icon/{match.group(1)}.png",
+                "icon_img": "",
+            }}, head, headers)
+        match = re.fullmatch(r"/r/(\w+)/comments/(\w+)/crosspost\.json", path)
+        if match:
+            # the cross-posted post is an image post with its own media
+            post = fake.post(match.group(1), fake.post_index(match.group(1), match.group(2)))
+            post["url"] = f"{fake.base_url}/media/x{post['id']}.jpg"
+            return self.send_json([{"kind": "Listing", "data": {"children": [{"kind": "t3", "data": post}]}}],
+                                  head, headers)
+
+        self.send_error(404)
+
+    def send_json(self, data, head: bool, headers: dict = None):
+        self.send_body(json.dumps(data).encode(), "application/json", head, headers=headers)
+
+    def send_blob(self, path: str, size: int, content_type: str, head: bool, image: bool = False):
+        data = self.fake.image(path, size) if image else self.fake.blob(path, size)
+        # support resuming, like the real media hosts
+        match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            if start >= len(data):
+                return self.send_body(b"", content_type, head, status=416)
+            return self.send_body(data[start:], content_type, head, status=206, headers={
+                "Content-Range": f"bytes {start}-{len(data) - 1}/{len(data)}"
+            })
+        self.send_body(data, content_type, head, headers={"Accept-Ranges": "bytes"})
+
+    def send_body(self, body: bytes, content_type: str, head: bool, status: int = 200, headers: dict = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if head:
+            return
+        fake = self.fake
+        try:
+            for i in range(0, len(body), CHUNK_SIZE):
+                chunk = body[i:i + CHUNK_SIZE]
+                self.wfile.write(chunk)
+                if fake.bandwidth:
+                    time.sleep(len(chunk) / fake.bandwidth)
+        except (BrokenPipeError, ConnectionResetError):
+            return
+        with fake.lock:
+            fake.bytes_sent += len(body)
+
+
+def start(fake: FakeReddit, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """
+    Starts the fake server in a background thread.
+    :param fake: The content and behaviour of the server.
+    :param host: The address to listen on.
+    :param port: The port to listen on (0 for any free port).
+    :return: The running server. Call shutdown() on it to stop it.
+    """
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    httpd.fake = fake
+    fake.base_url = f"http://{host}:{httpd.server_address[1]}"
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves a fake reddit for offline testing")
+    parser.add_argument("--port", type=int, default=7021)
+    parser.add_argument("--posts", type=int, default=1000, help="The amount of posts in every subreddit")
+    parser.add_argument("--image-size", type=parse_size, default="200K", help="The size of image files")
+    parser.add_argument("--video-size", type=parse_size, default="2M", help="The size of 720p video files")
+    parser.add_argument("--latency", type=float, default=0, help="Seconds to wait before answering any request")
+    parser.add_argument("--bandwidth", type=parse_size, default="0", help="Bytes per second per connection")
+    parser.add_argument("--duplicate-every", type=int, default=0, help="Every nth post reuses the previous media")
+    parser.add_argument("--ratelimit-budget", type=int, default=0, help="Json requests allowed per window")
+    parser.add_argument("--ratelimit-window", type=float, default=600, help="The rate limit window in seconds")
+    parser.add_argument("--throttle-every", type=int, default=0, help="Answer every nth request with 429")
+    a = parser.parse_args()
+    server = start(
+        FakeReddit(a.posts, a.image_size, a.video_size, a.latency, a.bandwidth, a.duplicate_every,
+                   a.ratelimit_budget, a.ratelimit_window, a.throttle_every),
+        port=a.port
+    )
+    print(f"Serving a fake reddit on {server.fake.base_url} (use --reddit-url {server.fake.base_url})")
+    print(f"Set HTTP_PROXY={server.fake.base_url} so imgur links are served from here too")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
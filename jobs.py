@@ -0,0 +1,92 @@
+# A queue of subreddits to download, kept in the database so a batch run can be stopped and picked up again later.
+import time
+
+from constants import cur, db
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class Job:
+    def __init__(self, job_id, subreddit, post_limit, state, posts, error, created, updated):
+        self.id = job_id
+        self.subreddit = subreddit
+        self.limit = post_limit
+        self.state = state
+        self.posts = posts
+        self.error = error
+        self.created = created
+        self.updated = updated
+
+
+def enqueue(subreddits: list[str], limit: int) -> int:
+    """
+    Adds subreddits to the queue. Subreddits that are already waiting in the queue get the new limit instead.
+    :param subreddits: The subreddits to download.
+    :param limit: The amount of posts to download from each.
+    :return: The amount of jobs that were added.
+    """
+    added = 0
+    now = int(time.time())
+    for subreddit in subreddits:
+        subreddit = subreddit.strip().replace("/r/", "")
+        if not subreddit:
+            continue
+        cur.execute(
+            "UPDATE `jobs` SET `post_limit` = ?, `updated` = ? WHERE `subreddit` = ? AND `state` IN (?, ?)",
+            (limit, now, subreddit, PENDING, RUNNING)
+        )
+        if cur.rowcount == 0:
+            cur.execute(
+                "INSERT INTO `jobs` (`subreddit`, `post_limit`, `state`, `posts`, `created`, `updated`) "
+                "VALUES (?, ?, ?, 0, ?, ?)",
+                (subreddit, limit, PENDING, now, now)
+            )
+            added += 1
+    db.commit()
+    return added
+
+
+def recover() -> int:
+    """
+    Puts jobs that were running when an earlier run crashed or was interrupted back in the queue.
+    :return: The amount of jobs that were put back.
+    """
+    cur.execute("UPDATE `jobs` SET `state` = ?, `updated` = ? WHERE `state` = ?", (PENDING, int(time.time()), RUNNING))
+    db.commit()
+    return cur.rowcount
+
+
+def claim() -> Job or None:
+    """
+    Takes the oldest job from the queue and marks it as running.
+    :return: The job, or None if the queue is empty.
+    """
+    cur.execute("SELECT * FROM `jobs` WHERE `state` = ? ORDER BY `id` LIMIT 1", (PENDING,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    job = Job(*row)
+    job.state = RUNNING
+    cur.execute("UPDATE `jobs` SET `state` = ?, `updated` = ? WHERE `id` = ?", (RUNNING, int(time.time()), job.id))
+    db.commit()
+    return job
+
+
+def finish(job: Job, state: str, posts: int = 0, error: str = None):
+    job.state = state
+    cur.execute(
+        "UPDATE `jobs` SET `state` = ?, `posts` = ?, `error` = ?, `updated` = ? WHERE `id` = ?",
+        (state, posts, error, int(time.time()), job.id)
+    )
+    db.commit()
+
+
+def list_jobs(states: tuple = (PENDING, RUNNING, FAILED)) -> list[Job]:
+    cur.execute(
+        "SELECT * FROM `jobs` WHERE `state` IN (%s) ORDER BY `id`" % ", ".join("?" * len(states)),
+        states
+    )
+    return [Job(*row) for row in cur.fetchall()]
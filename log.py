@@ -1,11 +1,17 @@
+import os
 import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import as_completed
+from contextlib import contextmanager
 from os.path import exists
 from types import SimpleNamespace
-import requests
 import termcolor as tc
 import datetime
 import tqdm
 import constants
+import net
 
 
 class Logger:
@@ -44,28 +50,117 @@ class Logger:
             print(self.log(msg, 'ERROR', 'red'))
 
 
+class stats(SimpleNamespace):
+    """
+    Counters and per-stage timings of the download pipeline, for the benchmarks.
+    Stage timings are summed over every thread, so stages running on the workers can add up to more than the wall time.
+    """
+    timings = defaultdict(float)
+    counters = defaultdict(int)
+    lock = threading.Lock()
+
+    @staticmethod
+    def add(counter: str, amount: int = 1):
+        with stats.lock:
+            stats.counters[counter] += amount
+
+    @staticmethod
+    @contextmanager
+    def timer(stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with stats.lock:
+                stats.timings[stage] += time.perf_counter() - start
+
+    @staticmethod
+    def timed(iterable, stage: str):
+        """
+        Wraps an iterable, counting the time spent waiting for each item towards a stage.
+        """
+        iterator = iter(iterable)
+        while True:
+            with stats.timer(stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    @staticmethod
+    def reset():
+        with stats.lock:
+            stats.timings.clear()
+            stats.counters.clear()
+
+
 class progress(SimpleNamespace):
     @staticmethod
-    def request_progress(url: str, target_file: str, message: str):
+    @stats.timer("media")
+    def request_progress(url: str, target_file: str, message: str, quiet: bool = False) -> int:
+        """
+        Downloads a file to a .part file next to the target, resuming it with a range request if an earlier download
+        was interrupted, and renames it to the target once it is complete.
+        :param url: The URL to download.
+        :param target_file: The path to save the file to.
+        :param message: The message to print before the download starts.
+        :param quiet: Whether to hide the progress bar, for when several files are downloaded at once.
+        :return: The size of the complete file.
+        """
         bar = "━"
         if exists(target_file):
-            print(tc.colored(f"File {target_file} already exists, skipping download", 'yellow'))
-        with open(target_file, "wb") as f:
+            if not quiet:
+                print(tc.colored(f"File {target_file} already exists, skipping download", 'yellow'))
+            return os.path.getsize(target_file)
+
+        part_file = target_file + ".part"
+        dl = os.path.getsize(part_file) if exists(part_file) else 0
+        if not quiet:
             print(tc.colored(message, "cyan"))
-            r = requests.get(url, stream=True, headers=constants.USERAGENT)
-            total_length = r.headers.get('content-length')
-            if total_length is None:
-                f.write(r.content)
-            else:
+        with net.get(url, stream=True, headers={"Range": f"bytes={dl}-"} if dl else None) as r:
+            if r.status_code == 416:
+                # the partial file already has every byte
+                os.replace(part_file, target_file)
+                return dl
+            r.raise_for_status()
+            if r.status_code != 206:
+                # the server doesn't support ranges, so we have to start over
                 dl = 0
-                total_length = int(total_length)
+            total_length = r.headers.get('content-length')
+            total_length = dl + int(total_length) if total_length is not None else None
+            with open(part_file, "ab" if dl else "wb") as f:
                 for data in r.iter_content(chunk_size=4096):
                     dl += len(data)
+                    stats.add("bytes", len(data))
+                    net.throttle(len(data))
                     f.write(data)
-                    done = int(50 * dl / total_length)
-                    sys.stdout.write(f"\r[{bar * done}{bar * (50 - done)}] {int(100 * dl / total_length)}%")
-                    sys.stdout.flush()
-        print()
+                    # several files are being downloaded at once when quiet, so a bar per file would garble the output
+                    if total_length and not quiet:
+                        done = int(50 * dl / total_length)
+                        sys.stdout.write(f"\r[{bar * done}{bar * (50 - done)}] {int(100 * dl / total_length)}%")
+                        sys.stdout.flush()
+        os.replace(part_file, target_file)
+        if not quiet:
+            print()
+        return dl
+
+    @staticmethod
+    def completed(futures, message: str):
+        return tqdm.tqdm(
+            as_completed(futures),
+            total=len(futures),
+            desc=message,
+            bar_format="{desc} {percentage:3.0f}% |{bar}| {n_fmt}/{total_fmt}"
+        )
+
+    @staticmethod
+    def counter(total: int, message: str):
+        return tqdm.tqdm(
+            total=total,
+            desc=message,
+            bar_format="{desc} {percentage:3.0f}% |{bar}| {n_fmt}/{total_fmt}"
+        )
 
     @staticmethod
     def range(start: int, end: int, message: str):
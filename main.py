@@ -5,33 +5,47 @@
 # such as subreddits, posts, and comments.
 #
 
+import functools
+import multiprocessing
 import time
 import webbrowser
 import shutil
+import xml.etree.ElementTree as ElementTree
+import requests
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from contextlib import nullcontext
+from queue import Empty
 from inspect import signature
+from urllib.parse import urlparse
 from pick import pick
 
 import utils
 from utils import *
 from constants import *
 
+import connections
+import database
+import jobs
 import media
+import net
+import phash
+import scheduler
+import store
+import thumbnails
 import url_handler
 import server
 
 
 def get_media_url(post: dict) -> str or None:
-    t = url_handler.get_handler(post['url'])
-    if t:
-        logger.info("Using special URL handler for " + post['url'])
-        url = t(requests.get(post['url']).text)
-        if url is None:
-            logger.error("URL handler returned None")
-            return None
-        logger.info("URL: " + url)
-        return url
+    if url_handler.get_handler(post['url']):
+        return resolve_url(post['url'])
     if post["is_video"]:
-        url = post["media"]["reddit_video"]["fallback_url"]
+        video = post["media"]["reddit_video"]
+        if args.max_video_height or args.max_video_bitrate:
+            return resolve_video(
+                video["fallback_url"], video.get("dash_url"), video.get("height"), video.get("bitrate_kbps")
+            )
+        url = video["fallback_url"]
     else:
         url = post["url"] if not post["url"].startswith("/r/") else None  # selftext posts
 
@@ -39,107 +53,488 @@ def get_media_url(post: dict) -> str or None:
         return None
 
     # check if url is a cross-post
-    if url.startswith("https://www.reddit.com/r/"):
+    if url.startswith(REDDIT_URL + "/r/"):
         if url.endswith("/"):
             return None
-        # get the post
-        print(url)
-        data = requests.get(url + ".json", headers=USERAGENT).json()
-        # get the media url
-        url = get_media_url(data[0]["data"]["children"][0]["data"])
+        return resolve_url(url)
 
     return url
 
 
-def download(subreddit: str, limit: int = 50) -> int:
+@functools.lru_cache(maxsize=RESOLVE_CACHE_SIZE)
+@log.stats.timer("resolve")
+def resolve_url(url: str) -> str or None:
+    """
+    Resolves a URL that needs an extra request (special handlers and cross-posts) to the URL of its media.
+    Results are kept in memory and in the database, so the same URL is only resolved once (handler results are
+    resolved again after --handler-cache-ttl days, since those pages can change). New results are written by the
+    PostWriter of the download, see save_resolutions.
+    :param url: The URL to resolve.
+    :return: The URL of the media, or None if there is no media.
+    """
+    t = url_handler.get_handler(url)
+    row = _saved_resolution(url, args.handler_cache_ttl * 24 * 3600 if t else 0)
+    if row:
+        return row[0] or None  # an empty string means the page had no media
 
-    # sometimes, the limit can be passed as a string, not sure why
-    limit = int(limit)
+    if t:
+        logger.info("Using special URL handler for " + url)
+        resolved = url_handler.run_handler(url, t)
+        if resolved is None:
+            logger.error("URL handler returned None")
+            # don't fetch the page again until the result expires
+            _unsaved_resolutions.append((url, ""))
+            return None
+        logger.info("URL: " + resolved)
+    else:
+        # get the cross-posted post
+        logger.debug("Resolving cross-post " + url)
+        r = net.get(url + ".json")
+        r.raise_for_status()
+        data = r.json()
+        # get the media url
+        resolved = get_media_url(data[0]["data"]["children"][0]["data"])
+        if resolved is None:
+            return None
 
-    # check if the sub exists
-    if not requests.get(f"https://reddit.com/r/{subreddit}.json",
-                        headers=USERAGENT).url == f"https://www.reddit.com/r/{subreddit}.json":
+    _unsaved_resolutions.append((url, resolved))
+    return resolved
+
+
+@functools.lru_cache(maxsize=RESOLVE_CACHE_SIZE)
+def resolve_video(fallback_url: str, dash_url: str or None, height: int or None, bitrate: int or None) -> str:
+    """
+    Picks the rendition of a reddit video that fits --max-video-height and --max-video-bitrate.
+    :return: The URL of the rendition, or the fallback URL (the best rendition) if the manifest can't be read.
+    """
+    video = {"fallback_url": fallback_url, "dash_url": dash_url, "height": height, "bitrate_kbps": bitrate}
+    # the choice depends on the limits, so they are part of the key
+    key = f"{dash_url or fallback_url}#{args.max_video_height}p{args.max_video_bitrate}k"
+    row = _saved_resolution(key)
+    if row:
+        return row[0]
+    try:
+        with log.stats.timer("resolve"):
+            resolved = url_handler.get_video_url(video, args.max_video_height, args.max_video_bitrate)
+    except (requests.exceptions.RequestException, ElementTree.ParseError, ValueError) as e:
+        logger.warn(f"Couldn't read the manifest of {dash_url}, using the best rendition: {e}")
+        return fallback_url
+    if resolved != fallback_url:
+        log.stats.add("smaller_renditions")
+    _unsaved_resolutions.append((key, resolved))
+    return resolved
+
+
+def _saved_resolution(url: str, max_age: float = 0) -> tuple or None:
+    """
+    Looks up an earlier resolution of a URL.
+    :param url: The URL.
+    :param max_age: How many seconds old the resolution can be (0 for any age).
+    :return: The row with the resolved URL, or None if there is none that is new enough.
+    """
+    cur.execute("SELECT `resolved`, `resolved_at` FROM `resolved_urls` WHERE `url` = ?", (url,))
+    row = cur.fetchone()
+    if row is None or (max_age and (row[1] or 0) < time.time() - max_age):
+        return None
+    return row
+
+
+_unsaved_resolutions = []
+
+
+def save_resolutions(writer: database.PostWriter):
+    """
+    Hands the URLs that were resolved since the last call to a writer, so they are written with its next batch.
+    """
+    while _unsaved_resolutions:
+        writer.record_resolved(*_unsaved_resolutions.pop())
+
+
+def iter_posts(subreddit: str, limit: int = 50, known: set = None, since: int = None, last_name: str = None):
+    """
+    Pages through the listing of a subreddit, yielding the posts of each page as soon as it arrives.
+    The first page is requested right away, so a subreddit that doesn't exist is reported before anything else.
+    :param subreddit: The subreddit to get the posts from.
+    :param limit: The amount of posts to get.
+    :param known: The ids of posts that are already downloaded. Paging stops at the first one.
+    :param since: The creation time of the newest downloaded post. Paging stops at the first post that isn't newer.
+    :param last_name: The fullname of the newest downloaded post. Paging stops when it is reached.
+    :return: A generator of post dicts from the reddit json api.
+    """
+    # the default (hot) listing isn't sorted by time, so stopping at a known post only works on the new listing
+    incremental = known is not None or since is not None or last_name is not None
+    path = f"/r/{subreddit}/new.json" if incremental else f"/r/{subreddit}.json"
+    # reddit redirects to a search page if the subreddit doesn't exist
+    r = net.get(REDDIT_URL + path, params={"limit": min(limit, LISTING_PAGE_SIZE)})
+    if r.status_code == 404 or urlparse(r.url).path.lower() != path.lower():
         raise ValueError(f"Subreddit '{subreddit}' does not exist!")
+    # anything else (rate limited, private, quarantined or down) is reported with its status
+    r.raise_for_status()
+    return _iter_pages(path, limit, r.json(), known, since, last_name)
 
-    posts = []
 
-    utils.get_icon(subreddit)
+def _iter_pages(path: str, limit: int, data: dict, known: set = None, since: int = None, last_name: str = None):
+    # we'll use the reddit json api to get the posts, as many at a time as it allows
+    seen = 0
+    with log.progress.counter(limit, "Downloading post information") as bar:
+        while True:
+            # take the posts off the page one at a time, so each one can be freed as soon as it has been used
+            children = data["data"]["children"]
+            children.reverse()
+            while children:
+                post = children.pop()
+                if seen >= limit:
+                    return
+                seen += 1
+                bar.update()
+                # the new listing is newest first, so everything after the first known post is known too
+                # (stickied posts are pinned to the top no matter how old they are)
+                if not post["data"]["stickied"] and (
+                        (known is not None and post["data"]["id"] in known)
+                        or (since is not None and post["data"]["created_utc"] <= since)
+                        or post["data"]["name"] == last_name
+                ):
+                    logger.info(f"Reached already downloaded post {post['data']['id']}, stopping")
+                    return
+                if args.only_nsfw and not post["data"]["over_18"]:
+                    continue
+                elif args.no_nsfw and post["data"]["over_18"]:
+                    continue
+                yield post["data"]
+
+            # the last page of the listing has no "after"
+            if seen >= limit or not data["data"]["after"]:
+                return
+            r = net.get(
+                REDDIT_URL + path,
+                params={"limit": min(limit - seen, LISTING_PAGE_SIZE), "count": seen, "after": data["data"]["after"]}
+            )
+            # a 429 that outlasted the retries has a json body too, but no listing in it
+            r.raise_for_status()
+            data = r.json()
+
+
+def get_phash_index() -> phash.PHashIndex:
+    """
+    Gets the index of the perceptual hashes of every downloaded image, loading it from the database the first time.
+    """
+    global _phash_index
+    if _phash_index is None:
+        _phash_index = phash.PHashIndex.load(cur)
+    return _phash_index
+
+
+_phash_index = None
+
+
+def fetch_media(post: "Post", message: str, quiet: bool, known: tuple = None) -> tuple[str, int, int or None]:
+    """
+    Downloads the media of a post into the media store and computes its perceptual hash. Runs on the download workers.
+    :param post: The post.
+    :param message: The message to print before the download starts.
+    :param quiet: Whether to hide the progress bar.
+    :param known: The hash and size of the file the URL pointed to last time, if it was downloaded before.
+    :return: The hash and size of the file, and the perceptual hash if it is an image.
+    """
+    digest, size = store.fetch(post.file_url, post.path, message, quiet, known)
+    h = None
+    if not post.is_video:
+        with log.stats.timer("phash"):
+            try:
+                h = phash.file_hash(post.path)
+            except (OSError, ValueError):
+                pass  # not an image we can open (broken or truncated)
+    return digest, size, h
+
+
+def download(subreddit: str, limit: int = 50, pool: scheduler.Scheduler = None,
+             writer: database.PostWriter = None, thumbnailer: ProcessPoolExecutor = None) -> int:
 
-    # we'll use the reddit json api to get the posts
-    # first request to get the last id
-    data = requests.get(f"https://www.reddit.com/r/{subreddit}.json?count=25", headers=USERAGENT).json()
-    for _ in log.progress.range(0, (limit // 25), "Downloading post information"):
-        last_id = ""
-        for post in data["data"]["children"]:
-            del post["data"]["all_awardings"]  # we don't need this, and it's a lot of data
-            if args.only_nsfw and not post["data"]["over_18"]:
-                continue
-            elif args.no_nsfw and post["data"]["over_18"]:
-                continue
-            posts.append(post["data"])
-            last_id = post["data"]["name"]
+    # sometimes, the limit can be passed as a string, not sure why
+    limit = int(limit)
 
-        data = requests.get(
-            f"https://www.reddit.com/r/{subreddit}.json?count=25&after={last_id}",
-            headers=USERAGENT
-        ).json()
+    known = since = last_name = None
+    if args.incremental:
+        cur.execute("SELECT `id` FROM `posts` WHERE `subreddit` = ?", (subreddit,))
+        known = {row[0] for row in cur.fetchall()}
+        cur.execute("SELECT `last_name`, `last_created` FROM `sync_state` WHERE `subreddit` = ?", (subreddit,))
+        last_name, since = cur.fetchone() or (None, None)
+        logger.debug(f"Incremental download of {subreddit}: {len(known)} known posts, newest is {last_name} "
+                     f"from {since}")
+    newest = None
 
-    logger.info(
-        f"{len(posts)} posts found ({len(posts) - limit} {'extra' if (len(posts) - limit) > 0 else 'discarded'} posts)"
-    )
+    # this also checks that the sub exists
+    with log.stats.timer("listing"):
+        posts = iter_posts(subreddit, limit, known, since, last_name)
+
+    icon = utils.get_icon(subreddit)
 
     # create the media directory for the sub if it doesn't exist
     if not exists(DATA_DIR + f"media/{subreddit}/"):
         logger.info(f"Creating media directory for {subreddit}")
         os.mkdir(DATA_DIR + f"media/{subreddit}/")
 
-    # Download the files
-    for i, post in enumerate(posts):
-        file = get_media_url(post)
-        if file is None:
-            logger.info(f"Self-text post {post['title']} (no file)")
-            continue
+    index = get_phash_index()
 
+    def report(future):
+        post = futures.pop(future)
         try:
-            cur.execute(
-                'INSERT INTO `posts` VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                (
-                    post["id"],
-                    post["title"],
-                    post["permalink"],
-                    post['id'],
-                    post["author"],
-                    int(post["created_utc"]),
-                    "mp4" if post["is_video"] else "jpg",
-                    get_media_url(post), post["is_video"],
-                    post["over_18"],
-                    post["spoiler"],
-                    post["score"],
-                    post["upvote_ratio"] * 100,
-                    subreddit,
-                    (DATA_DIR +
-                     f"media/{subreddit}/{post['id']}")
-                    if get_media_url(post)
-                    else None
-                )
+            digest, size, h = future.result()
+        except (requests.exceptions.RequestException, OSError) as e:
+            logger.error(f"Failed to download post {post.id}: {e}")
+            writer.record_download(post.id, "failed")
+            return
+        log.stats.add("files")
+        state = "complete"
+        blob = digest, size
+        if h is not None:
+            similar = [match for match in index.search(h, args.phash_distance) if match[0] != post.id]
+            if similar:
+                logger.info(f"Post {post.id} looks like a repost of {similar[0][0]} (distance {similar[0][1]})")
+                log.stats.add("near_duplicates")
+                original = writer.post_path(similar[0][0])
+                if args.skip_near_duplicates and original and exists(original):
+                    # keep the original instead of this copy
+                    store.link(original, post.path)
+                    store.release(digest)
+                    if not exists(store.object_path(digest)):
+                        blob = None  # no other post had this file, so it is gone from the store
+                    state = "near-duplicate"
+                    # the copy was released, and the link takes no extra space
+                    digest, size = None, 0
+            writer.record_phash(post.id, h)
+            index.add(post.id, h)
+        if blob is not None:
+            writer.record_blob(post.file_url, *blob)
+        writer.record_download(post.id, state, size, digest)
+        if thumbnailer:
+            thumbnailer.submit(thumbnails.pregenerate, post.path).add_done_callback(_thumbnails_made)
+
+    def submit(posts_to_download):
+        for post in posts_to_download:
+            # don't get too far ahead of the downloads, so memory doesn't grow with the limit
+            while len(futures) >= max_in_flight:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    report(future)
+            known = writer.known_blob(post.file_url)
+            future = pool.submit(
+                fetch_media,
+                post,
+                f"Downloading post {tc.colored(post.title, 'blue')} [{tc.colored(post.id, 'magenta')}]",
+                quiet,
+                known,
+                url=post.file_url,
+                size=known[1] if known else None,
+                video=bool(post.is_video)
             )
-            db.commit()
-        except sqlite3.IntegrityError:
-            logger.debug(f"Post {post['id']} already exists in database")
-            continue
-        if file is None:
-            logger.error(f"Post {post['id']} has no file")
-            continue
-        log.progress.request_progress(
-            file,
-            DATA_DIR + f"media/{subreddit}/{post['id']}",
-            f"Downloading post {tc.colored(post['title'], 'blue')} [{tc.colored(post['id'], 'magenta')}]",
+            futures[future] = post
+
+    # Download the files while the listing is still being paged through, smallest first
+    # the workers only write their own file, all the database writes stay on this thread
+    quiet = args.workers > 1 or args.processes > 1 or bool(args.large_file_threshold)
+    # the listing waits while this many downloads are queued or running (the size order only applies among these)
+    max_in_flight = (args.workers + args.large_workers) * IN_FLIGHT_PER_WORKER
+    found = 0
+    writer = writer or database.PostWriter(db, args.batch_size)
+    writer.record_icon(subreddit, "present" if icon else "none")
+    # a thumbnail pool of this download is left last, so the web UI finds every thumbnail ready once it is done
+    with nullcontext(pool) if pool else scheduler.Scheduler() as pool, \
+            nullcontext(thumbnailer) if thumbnailer else thumbnail_pool() as thumbnailer:
+        futures = {}
+        failure = None
+        try:
+            for data in log.stats.timed(posts, "listing"):
+                found += 1
+                log.stats.add("posts")
+                if not data["stickied"] and (newest is None or data["created_utc"] > newest[1]):
+                    newest = (data["name"], int(data["created_utc"]))
+                # report whatever finished while we were waiting on the listing
+                for future in [f for f in futures if f.done()]:
+                    report(future)
+
+                try:
+                    file = get_media_url(data)
+                except requests.exceptions.RequestException as e:
+                    # only this post is skipped (a cross-post of a removed post, say), the listing goes on
+                    logger.error(f"Failed to resolve the media of post {data['id']}: {e}")
+                    continue
+                finally:
+                    save_resolutions(writer)
+                if file is None:
+                    logger.info(f"Self-text post {data['title']} (no file)")
+                    continue
+
+                # only the columns we keep are held on to, the rest of the listing JSON is dropped here
+                # posts are written in batches, and only the ones that weren't in the database yet get downloaded
+                submit(writer.add(Post.from_listing(data, subreddit, file)))
+        except requests.exceptions.RequestException as e:
+            # the rest of the listing couldn't be fetched, but the posts we already have are still downloaded
+            failure = e
+        submit(writer.close())
+
+        logger.info(
+            f"{found} posts found ({found - limit} {'extra' if (found - limit) > 0 else 'discarded'} posts)"
         )
 
-    return len(posts)
+        for future in (log.progress.completed(list(futures), "Downloading media")
+                       if quiet else as_completed(list(futures))):
+            report(future)
+
+        # remember where this download stopped, so the next incremental one can stop there too
+        # (not after a failure, since the posts between here and the last download weren't all listed)
+        if newest is not None and failure is None:
+            writer.record_sync_state(subreddit, newest[0], max(newest[1], since or 0))
+        writer.close()
+        if failure is not None:
+            raise failure
+
+    return found
+
+
+def thumbnail_pool():
+    """
+    Makes the processes that make the thumbnails of new downloads, if --pregenerate-thumbnails is on.
+    :return: A ProcessPoolExecutor, or an empty context manager if thumbnails aren't made ahead of time.
+    """
+    if not args.pregenerate_thumbnails:
+        return nullcontext()
+    # resizing is CPU work, so it goes on processes instead of the download threads
+    # the download processes of a sharded download need CPU time too, so by default they each keep a core
+    return ProcessPoolExecutor(
+        max_workers=args.thumbnail_workers or max((os.cpu_count() or 1) - (args.processes - 1), 1),
+        mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def _thumbnails_made(future):
+    try:
+        log.stats.add("thumbnails", future.result())
+    except Exception as e:
+        logger.warn(f"Failed to make thumbnails: {e}")
+
+
+def _download_shard(subreddit: str, limit: int, queue) -> int:
+    # runs in a worker process of download_sharded, which writes everything this process sends it
+    # (and makes the thumbnails of its downloads, so there is only one thumbnail pool)
+    net.bandwidth_shares = args.processes
+    args.pregenerate_thumbnails = False
+    return download(subreddit, limit, writer=database.QueueWriter(db, queue, args.batch_size))
+
+
+def download_sharded(tasks, processes: int):
+    """
+    Downloads several subreddits at the same time, each one in its own process, so listing, hashing and phash work
+    isn't limited to one CPU core. The worker processes only read from the database; their batches are sent back to
+    this process, which writes them with a single connection.
+    :param tasks: An iterable of (subreddit, limit, ...) tuples. It is only advanced when a process is free, so it can
+    claim jobs as it goes.
+    :param processes: The amount of worker processes.
+    :return: A generator of (task, amount of posts found) for every task, with the exception instead of the amount
+    if the download failed.
+    """
+    ctx = multiprocessing.get_context("spawn")  # the parent has threads and open connections, so don't fork
+    writer = database.PostWriter(db, args.batch_size)
+    tasks = iter(tasks)
+    with ctx.Manager() as manager, ProcessPoolExecutor(max_workers=processes, mp_context=ctx) as executor, \
+            thumbnail_pool() as thumbnailer:
+        queue = manager.Queue()
+        running = {}
+
+        def write(batch):
+            writer.write(batch)
+            if thumbnailer:
+                for state, _, _, post_id in batch["downloads"]:
+                    path = writer.post_path(post_id) if state in database.FINISHED_STATES else None
+                    if path:
+                        thumbnailer.submit(thumbnails.pregenerate, path).add_done_callback(_thumbnails_made)
+
+        def drain():
+            while True:
+                try:
+                    write(queue.get_nowait())
+                except Empty:
+                    return
+
+        def fill():
+            while len(running) < processes:
+                task = next(tasks, None)
+                if task is None:
+                    return
+                running[executor.submit(_download_shard, task[0], task[1], queue)] = task
+
+        fill()
+        while running:
+            try:
+                write(queue.get(timeout=0.1))
+                continue
+            except Empty:
+                pass
+            for future in [f for f in running if f.done()]:
+                # a shard puts all its batches on the queue before it returns
+                drain()
+                task = running.pop(future)
+                try:
+                    yield task, future.result()
+                except Exception as e:  # anything that went wrong in the other process
+                    yield task, e
+            fill()
+        drain()
+    writer.close()
+
+
+def run_queue() -> int:
+    """
+    Downloads every subreddit in the job queue, one after another, sharing the download workers between them.
+    With --processes, several jobs run at the same time in their own processes.
+    Jobs that were interrupted last time are picked up again; posts that were already downloaded are skipped and
+    unfinished media downloads are resumed.
+    :return: The amount of jobs that were run.
+    """
+    recovered = jobs.recover()
+    if recovered:
+        logger.info(f"Resuming {recovered} interrupted jobs")
+    count = 0
+    if args.processes > 1:
+        def claimed():
+            while (job := jobs.claim()) is not None:
+                logger.info(f"Downloading {job.limit} posts from {job.subreddit} (job {job.id})")
+                yield job.subreddit, job.limit, job
+
+        for (_, _, job), result in download_sharded(claimed(), args.processes):
+            count += 1
+            if isinstance(result, Exception):
+                logger.error(f"Job {job.id} ({job.subreddit}) failed: {result}")
+                jobs.finish(job, jobs.FAILED, error=str(result))
+            else:
+                jobs.finish(job, jobs.DONE, result)
+        return count
+
+    with scheduler.Scheduler() as pool, thumbnail_pool() as thumbnailer:
+        while True:
+            job = jobs.claim()
+            if job is None:
+                break
+            count += 1
+            logger.info(f"Downloading {job.limit} posts from {job.subreddit} (job {job.id})")
+            try:
+                jobs.finish(job, jobs.DONE, download(job.subreddit, job.limit, pool, thumbnailer=thumbnailer))
+            except (ValueError, KeyError, requests.exceptions.RequestException) as e:
+                logger.error(f"Job {job.id} ({job.subreddit}) failed: {e}")
+                jobs.finish(job, jobs.FAILED, error=str(e))
+    return count
 
 
 class Post:
+    """
+    A post as it is stored in the posts table. Listing items are turned into these right away, so only the columns
+    we need are kept in memory, not the whole listing JSON.
+    """
+    __slots__ = (
+        "id", "title", "link", "generated_md5", "author", "time", "type", "file_url", "is_video", "nsfw", "spoiler",
+        "score", "vote_ratio", "subreddit", "path"
+    )
+
     def __init__(
             self,
             post_id,
@@ -174,6 +569,36 @@ class Post:
         self.subreddit = subreddit
         self.path = path
 
+    @classmethod
+    def from_listing(cls, data: dict, subreddit: str, file_url: str) -> "Post":
+        """
+        Makes a post from a listing item of the reddit json api.
+        :param data: The data of the listing item.
+        :param subreddit: The subreddit it was downloaded from.
+        :param file_url: The URL of its media.
+        """
+        return cls(
+            data["id"],
+            data["title"],
+            data["permalink"],
+            data["id"],
+            data["author"],
+            int(data["created_utc"]),
+            "mp4" if data["is_video"] else "jpg",
+            file_url,
+            data["is_video"],
+            data["over_18"],
+            data["spoiler"],
+            data["score"],
+            round(data["upvote_ratio"] * 100),
+            subreddit,
+            DATA_DIR + f"media/{subreddit}/{data['id']}"
+        )
+
+    def row(self) -> tuple:
+        # in the order of the columns of the posts table
+        return tuple(getattr(self, name) for name in self.__slots__)
+
 
 def header(width: int = term.width):
     row = (width - 10) // 5
@@ -213,7 +638,7 @@ def list_posts(subreddit: str, limit: int = 50) -> list[Post]:
             return []
 
     post_index = 0
-    query = 'SELECT * FROM `posts` WHERE `subreddit` = ?'
+    query = f'SELECT {database.POST_COLUMNS} FROM `posts` WHERE `subreddit` = ?'
 
     if args.only_nsfw:
         query += " AND `nsfw` = 1"
@@ -304,9 +729,13 @@ class InteractiveConsole:
             "Basic": CommandGroup("Reddit"),
             "download": Command("download", "Downloads posts from a subreddit", self.download),
             "list": Command("list", "Lists posts from a subreddit", self.list),
+            "search": Command("search", "Searches the titles, authors and subreddits of downloaded posts", self.search),
             "open": Command("open", "Opens a post in the browser", self.open),
             "delete": Command("delete", "Deletes a post from the database", self.delete),
             "sync": Command("sync", "Synchronizes the media files with the database", self.sync),
+            "enqueue": Command("enqueue", "Adds comma-separated subreddits to the download queue", self.enqueue),
+            "queue": Command("queue", "Lists the jobs in the download queue", self.queue),
+            "run_queue": Command("run_queue", "Downloads every subreddit in the download queue", self.run_queue),
             "list_downloaded": Command("list_downloaded", "Lists downloaded subreddits", self.list_downloaded),
 
             "Dangerous": CommandGroup("Dangerous"),
@@ -344,6 +773,18 @@ class InteractiveConsole:
             return
         list_posts(subreddit, limit)
 
+    @staticmethod
+    def search(*words: str):
+        if not words:
+            print("Please specify what to search for!")
+            return
+        posts = [Post(*row) for row in database.search_posts(cur, " ".join(words), limit=50)]
+        if not posts:
+            print("No posts found")
+            return
+        for post in posts:
+            print(f"{post.id}\t/r/{post.subreddit}\tu/{post.author}\t{post.title}")
+
     @staticmethod
     def open(post_id: int):
         if not post_id:
@@ -365,6 +806,24 @@ class InteractiveConsole:
         sync_files(subreddit)
         print("done")
 
+    @staticmethod
+    def enqueue(subreddits: str, limit: int = 50):
+        if not subreddits:
+            print("Please specify a subreddit!")
+            return
+        print(f"Added {jobs.enqueue(subreddits.split(','), int(limit))} jobs")
+
+    @staticmethod
+    def queue():
+        print("Queued jobs:")
+        for job in jobs.list_jobs():
+            print(f"{job.id}\t{job.state}\t/r/{job.subreddit}\t{job.limit} posts" +
+                  (f"\t{job.error}" if job.error else ""))
+
+    @staticmethod
+    def run_queue():
+        run_queue()
+
     @staticmethod
     def list_downloaded():
         print("Downloaded subreddits:")
@@ -377,13 +836,17 @@ class InteractiveConsole:
             return
         print("Resetting...", end="")
         start_time = time.time()
-        os.remove(os.path.join(DATA_DIR, "data.db"))
+        db.close()  # the connection keeps the WAL and shared memory files around
+        connections.remove(os.path.join(DATA_DIR, "data.db"))
         print("Deleted database")
         shutil.rmtree(DATA_DIR + "media")
+        shutil.rmtree(DATA_DIR + "objects", ignore_errors=True)
+        shutil.rmtree(DATA_DIR + "thumbnails", ignore_errors=True)
         print("Deleted media directory")
         print("Done ({}s)".format(time.time() - start_time))
-        # the database wouldn't exist, so there would probably be errors when anything tries to access it
+        # the database is closed and gone, so there would be errors when anything tries to access it
         print("Exiting...")
+        sys.exit()
 
     def start(self):
         print("Interactive console mode")
@@ -406,9 +869,9 @@ class InteractiveConsole:
 
 
 def get_subreddit_list():
-    cur.execute("SELECT DISTINCT `subreddit` FROM `posts`")
-    repeating = [col[0] for col in cur.fetchall()]
-    return list(set(repeating))
+    # kept up to date by triggers, so this doesn't have to go through every post
+    cur.execute("SELECT `name` FROM `subreddits` WHERE `posts` > 0 ORDER BY `name`")
+    return [row[0] for row in cur.fetchall()]
 
 
 if __name__ == "__main__":
@@ -437,19 +900,35 @@ if __name__ == "__main__":
             exit()
         print("Resetting...", end="")
         start = time.time()
-        os.remove(os.path.join(DATA_DIR, "data.db"))
+        db.close()  # the connection keeps the WAL and shared memory files around
+        connections.remove(os.path.join(DATA_DIR, "data.db"))
         print("Deleted database")
         shutil.rmtree(DATA_DIR + "media")
+        shutil.rmtree(DATA_DIR + "objects", ignore_errors=True)
+        shutil.rmtree(DATA_DIR + "thumbnails", ignore_errors=True)
         print("Deleted media directory")
         print("Done ({}s)".format(time.time() - start))
         exit()
     else:
         if args.mode == "download":
-            logger.debug("Downloading from %s" % args.sub.replace("/r/", ""))
-            download(args.sub, args.limit)
+            subs = [sub.strip().replace("/r/", "") for sub in args.sub.split(",") if sub.strip()]
+            logger.debug("Downloading from %s" % ", ".join(subs))
+            if len(subs) > 1 and args.processes > 1:
+                for (sub, _), result in download_sharded([(sub, args.limit) for sub in subs], args.processes):
+                    if isinstance(result, Exception):
+                        logger.error(f"Failed to download {sub}: {result}")
+            else:
+                with thumbnail_pool() as thumbnailer:
+                    for sub in subs:
+                        download(sub, args.limit, thumbnailer=thumbnailer)
         elif args.mode == "list":
             logger.debug("Listing posts from %s" % args.sub)
             list_posts(args.sub, args.limit)
         elif args.mode == "sync":
             logger.debug("Syncing %s" % args.sub)
             sync_files(args.sub)
+        elif args.mode == "enqueue":
+            logger.debug("Queueing %s" % args.sub)
+            print(f"Added {jobs.enqueue(args.sub.split(','), args.limit)} jobs")
+        elif args.mode == "run-queue":
+            run_queue()
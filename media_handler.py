@@ -2,18 +2,18 @@ from types import SimpleNamespace
 import re
 
 
-# for using within the handlers
+# for using within the handlers, these find the media URL anywhere in a page
 REGEXES = {
-    "imgur": re.compile(r"^(https?://)?(www\.)?i\.imgur\.com/([a-zA-Z\d]{5,7})(\.[a-zA-Z]{3,4})?$"),
-    "gfycat": re.compile(r"^(https?://)?(www\.)?thumbs\.gfycat\.com/.+\.([a-zA-Z\d]{3,4})?$"),
+    "imgur": re.compile(r"https?://i\.imgur\.com/[a-zA-Z\d]{5,7}\.[a-zA-Z\d]{3,4}"),
+    "gfycat": re.compile(r"https?://thumbs\.gfycat\.com/[\w-]+\.[a-zA-Z\d]{3,4}"),
 }
 
 
 def find(html, regex_name):
-    matches = REGEXES[regex_name].findall(html)
-    if len(matches) == 0:
+    match = REGEXES[regex_name].search(html)
+    if match is None:
         return None
-    return matches[0]
+    return match.group(0)
 
 
 class SimpleHandlers(SimpleNamespace):
@@ -0,0 +1,406 @@
+# Versioned migrations of the database schema. Every migration runs once, in order, and the schema_version table
+# remembers how far a database got, so older databases are upgraded in place the next time they are opened.
+# To change the schema, add a new migration to the end of MIGRATIONS, never edit one that was already released.
+import os
+import sqlite3
+
+import constants
+import errors
+from constants import logger
+
+
+def _baseline(cur: sqlite3.Cursor):
+    """the tables from before migrations"""
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS `posts` (
+            "id"	TEXT UNIQUE,
+            "title"	TEXT,
+            "link"	TEXT,
+            "generated_md5"	TEXT,
+            "author"	TEXT,
+            "time"	INT,
+            "type"	TEXT,
+            "file_url"	TEXT,
+            "is_video"	INT,
+            "nsfw"	INT,
+            "spoiler"	INT,
+            "score"	INT,
+            "vote_ratio"	INT,
+            "subreddit"	TEXT,
+            "path"	TEXT
+        );
+        """
+    )
+
+    # special handler and cross-post URLs that have already been resolved to a media URL
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS `resolved_urls` (
+            "url"	TEXT PRIMARY KEY,
+            "resolved"	TEXT,
+            "resolved_at"	INTEGER
+        );
+        """
+    )
+    _add_column(cur, "resolved_urls", "resolved_at", "INTEGER")
+
+    # the state of the media download of each post, so interrupted downloads can be resumed
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS `downloads` (
+            "post_id"	TEXT PRIMARY KEY,
+            "state"	TEXT,
+            "size"	INT,
+            "hash"	TEXT
+        );
+        """
+    )
+    # databases from before the media store don't have the hash column yet
+    _add_column(cur, "downloads", "hash", "TEXT")
+
+    # the files in the media store, and the URLs they were downloaded from
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS `blobs` (
+            "hash"	TEXT PRIMARY KEY,
+            "size"	INT
+        );
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS `blob_urls` (
+            "url"	TEXT PRIMARY KEY,
+            "hash"	TEXT,
+            "size"	INT
+        );
+        """
+    )
+
+    # the newest post of each subreddit, where incremental downloads stop paging
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS `sync_state` (
+            "subreddit"	TEXT PRIMARY KEY,
+            "last_name"	TEXT,
+            "last_created"	INT
+        );
+        """
+    )
+
+    # perceptual hashes of downloaded images, for finding near-duplicates
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS `phashes` (
+            "post_id"	TEXT PRIMARY KEY,
+            "hash"	INT
+        );
+        """
+    )
+
+    # the download queue, for downloading many subreddits in one run
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS `jobs` (
+            "id"	INTEGER PRIMARY KEY AUTOINCREMENT,
+            "subreddit"	TEXT,
+            "post_limit"	INT,
+            "state"	TEXT,
+            "posts"	INT,
+            "error"	TEXT,
+            "created"	INT,
+            "updated"	INT
+        );
+        """
+    )
+
+
+def _typed_posts(cur: sqlite3.Cursor):
+    """proper integer and boolean types for the posts table"""
+    # sqlite can't change the type of a column, so the table is copied into a new one
+    cur.execute(
+        """
+        CREATE TABLE `posts_new` (
+            "id"	TEXT NOT NULL UNIQUE,
+            "title"	TEXT,
+            "link"	TEXT,
+            "generated_md5"	TEXT,
+            "author"	TEXT,
+            "time"	INTEGER NOT NULL DEFAULT 0,
+            "type"	TEXT,
+            "file_url"	TEXT,
+            "is_video"	BOOLEAN NOT NULL DEFAULT 0,
+            "nsfw"	BOOLEAN NOT NULL DEFAULT 0,
+            "spoiler"	BOOLEAN NOT NULL DEFAULT 0,
+            "score"	INTEGER NOT NULL DEFAULT 0,
+            "vote_ratio"	INTEGER,
+            "subreddit"	TEXT NOT NULL,
+            "path"	TEXT
+        );
+        """
+    )
+    cur.execute(
+        """
+        INSERT INTO `posts_new`
+        SELECT `id`, `title`, `link`, `generated_md5`, `author`, CAST(IFNULL(`time`, 0) AS INTEGER), `type`,
+            `file_url`, IFNULL(`is_video`, 0) != 0, IFNULL(`nsfw`, 0) != 0, IFNULL(`spoiler`, 0) != 0,
+            CAST(IFNULL(`score`, 0) AS INTEGER), CAST(`vote_ratio` AS INTEGER), IFNULL(`subreddit`, ''), `path`
+        FROM `posts` WHERE `id` IS NOT NULL
+        """
+    )
+    cur.execute("DROP TABLE `posts`")
+    cur.execute("ALTER TABLE `posts_new` RENAME TO `posts`")
+
+
+def _indexes(cur: sqlite3.Cursor):
+    """indexes for listing posts by subreddit, time and score"""
+    cur.execute("CREATE INDEX IF NOT EXISTS `posts_subreddit_time` ON `posts` (`subreddit`, `time`)")
+    cur.execute("CREATE INDEX IF NOT EXISTS `posts_subreddit_score` ON `posts` (`subreddit`, `score`)")
+    cur.execute("CREATE INDEX IF NOT EXISTS `posts_time` ON `posts` (`time`)")
+    cur.execute("CREATE INDEX IF NOT EXISTS `jobs_state` ON `jobs` (`state`, `id`)")
+    # gives the query planner the statistics it needs to pick between the indexes
+    cur.execute("ANALYZE")
+
+
+def _keyset_indexes(cur: sqlite3.Cursor):
+    """indexes for paging by (time, id) and (score, id), and shuffle keys for random samples"""
+    for index in ("posts_subreddit_time", "posts_subreddit_score", "posts_time"):
+        cur.execute(f"DROP INDEX IF EXISTS `{index}`")
+    # the id makes the order unique, so a page can start right after the last post of the one before
+    cur.execute("CREATE INDEX `posts_subreddit_time` ON `posts` (`subreddit`, `time`, `id`)")
+    cur.execute("CREATE INDEX `posts_subreddit_score` ON `posts` (`subreddit`, `score`, `id`)")
+    cur.execute("CREATE INDEX `posts_time` ON `posts` (`time`, `id`)")
+    cur.execute("CREATE INDEX `posts_score` ON `posts` (`score`, `id`)")
+
+    # a random number per post, so a random sample is just a range of keys instead of sorting the whole table
+    _add_column(cur, "posts", "shuffle_key", "INTEGER")
+    cur.execute("UPDATE `posts` SET `shuffle_key` = RANDOM() WHERE `shuffle_key` IS NULL")
+    cur.execute("CREATE INDEX `posts_subreddit_shuffle` ON `posts` (`subreddit`, `shuffle_key`)")
+    cur.execute("CREATE INDEX `posts_shuffle` ON `posts` (`shuffle_key`)")
+    cur.execute("ANALYZE")
+
+
+def _search_index(cur: sqlite3.Cursor):
+    """a full-text index of post titles, authors and subreddits"""
+    try:
+        # the index only stores the words, and reads the text from the posts table by rowid
+        # (which only stays the same through a VACUUM since posts has an INTEGER PRIMARY KEY, see _post_keys)
+        cur.execute(
+            "CREATE VIRTUAL TABLE `posts_fts` USING fts5("
+            "`title`, `author`, `subreddit`, content='posts', content_rowid='rowid', "
+            "tokenize='unicode61 remove_diacritics 2')"
+        )
+    except sqlite3.OperationalError as e:
+        logger.warn(f"Full-text search is not available, searches will be slow: {e}")
+        return
+    cur.execute(
+        """
+        CREATE TRIGGER `posts_fts_insert` AFTER INSERT ON `posts` BEGIN
+            INSERT INTO `posts_fts` (`rowid`, `title`, `author`, `subreddit`)
+            VALUES (new.`rowid`, new.`title`, new.`author`, new.`subreddit`);
+        END
+        """
+    )
+    cur.execute(
+        """
+        CREATE TRIGGER `posts_fts_delete` AFTER DELETE ON `posts` BEGIN
+            INSERT INTO `posts_fts` (`posts_fts`, `rowid`, `title`, `author`, `subreddit`)
+            VALUES ('delete', old.`rowid`, old.`title`, old.`author`, old.`subreddit`);
+        END
+        """
+    )
+    cur.execute(
+        """
+        CREATE TRIGGER `posts_fts_update` AFTER UPDATE OF `title`, `author`, `subreddit` ON `posts` BEGIN
+            INSERT INTO `posts_fts` (`posts_fts`, `rowid`, `title`, `author`, `subreddit`)
+            VALUES ('delete', old.`rowid`, old.`title`, old.`author`, old.`subreddit`);
+            INSERT INTO `posts_fts` (`rowid`, `title`, `author`, `subreddit`)
+            VALUES (new.`rowid`, new.`title`, new.`author`, new.`subreddit`);
+        END
+        """
+    )
+    # index the posts that are already there
+    cur.execute("INSERT INTO `posts_fts` (`posts_fts`) VALUES ('rebuild')")
+
+
+def _subreddit_stats(cur: sqlite3.Cursor):
+    """a table of subreddits and their statistics, kept up to date by triggers"""
+    cur.execute(
+        """
+        CREATE TABLE `subreddits` (
+            "name"	TEXT PRIMARY KEY,
+            "posts"	INTEGER NOT NULL DEFAULT 0,
+            "media_bytes"	INTEGER NOT NULL DEFAULT 0,
+            "newest"	INTEGER,
+            "icon"	TEXT
+        );
+        """
+    )
+    cur.execute(
+        """
+        CREATE TRIGGER `subreddits_post_insert` AFTER INSERT ON `posts` BEGIN
+            INSERT OR IGNORE INTO `subreddits` (`name`) VALUES (new.`subreddit`);
+            UPDATE `subreddits` SET `posts` = `posts` + 1, `newest` = MAX(IFNULL(`newest`, new.`time`), new.`time`)
+            WHERE `name` = new.`subreddit`;
+        END
+        """
+    )
+    # the newest post has to be looked up again when a post is removed, which the (subreddit, time) index makes cheap
+    cur.execute(
+        """
+        CREATE TRIGGER `subreddits_post_delete` AFTER DELETE ON `posts` BEGIN
+            UPDATE `subreddits` SET
+                `posts` = `posts` - 1,
+                `media_bytes` = `media_bytes` - IFNULL((SELECT `size` FROM `downloads` WHERE `post_id` = old.`id`), 0),
+                `newest` = (SELECT MAX(`time`) FROM `posts` WHERE `subreddit` = old.`subreddit`)
+            WHERE `name` = old.`subreddit`;
+        END
+        """
+    )
+    cur.execute(
+        """
+        CREATE TRIGGER `subreddits_download_insert` AFTER INSERT ON `downloads` BEGIN
+            UPDATE `subreddits` SET `media_bytes` = `media_bytes` + IFNULL(new.`size`, 0)
+            WHERE `name` = (SELECT `subreddit` FROM `posts` WHERE `id` = new.`post_id`);
+        END
+        """
+    )
+    cur.execute(
+        """
+        CREATE TRIGGER `subreddits_download_update` AFTER UPDATE OF `size` ON `downloads` BEGIN
+            UPDATE `subreddits` SET `media_bytes` = `media_bytes` + IFNULL(new.`size`, 0) - IFNULL(old.`size`, 0)
+            WHERE `name` = (SELECT `subreddit` FROM `posts` WHERE `id` = new.`post_id`);
+        END
+        """
+    )
+    cur.execute(
+        """
+        CREATE TRIGGER `subreddits_download_delete` AFTER DELETE ON `downloads` BEGIN
+            UPDATE `subreddits` SET `media_bytes` = `media_bytes` - IFNULL(old.`size`, 0)
+            WHERE `name` = (SELECT `subreddit` FROM `posts` WHERE `id` = old.`post_id`);
+        END
+        """
+    )
+
+    # fill it in for the posts that are already there
+    cur.execute(
+        """
+        INSERT INTO `subreddits` (`name`, `posts`, `media_bytes`, `newest`)
+        SELECT `posts`.`subreddit`, COUNT(*), IFNULL(SUM(`downloads`.`size`), 0), MAX(`posts`.`time`)
+        FROM `posts` LEFT JOIN `downloads` ON `downloads`.`post_id` = `posts`.`id`
+        GROUP BY `posts`.`subreddit`
+        """
+    )
+    cur.execute("SELECT `name` FROM `subreddits`")
+    for (name,) in cur.fetchall():
+        icon = os.path.join(constants.DATA_DIR, "icons", name + ".jpg")
+        if os.path.exists(icon):
+            cur.execute(
+                "UPDATE `subreddits` SET `icon` = ? WHERE `name` = ?",
+                ("present" if os.path.getsize(icon) > 0 else "none", name)
+            )
+
+
+def _post_keys(cur: sqlite3.Cursor):
+    """an integer primary key for posts, so the search index keeps pointing at the right posts"""
+    # without an INTEGER PRIMARY KEY, a VACUUM can renumber the rowids the search index refers to
+    # the rowids are copied over, so the index is still right afterwards
+    cur.execute(
+        "SELECT `sql` FROM `sqlite_master` WHERE `tbl_name` = 'posts' AND `type` IN ('index', 'trigger') "
+        "AND `sql` IS NOT NULL"
+    )
+    schema = [row[0] for row in cur.fetchall()]
+    cur.execute(
+        """
+        CREATE TABLE `posts_new` (
+            "key"	INTEGER PRIMARY KEY,
+            "id"	TEXT NOT NULL UNIQUE,
+            "title"	TEXT,
+            "link"	TEXT,
+            "generated_md5"	TEXT,
+            "author"	TEXT,
+            "time"	INTEGER NOT NULL DEFAULT 0,
+            "type"	TEXT,
+            "file_url"	TEXT,
+            "is_video"	BOOLEAN NOT NULL DEFAULT 0,
+            "nsfw"	BOOLEAN NOT NULL DEFAULT 0,
+            "spoiler"	BOOLEAN NOT NULL DEFAULT 0,
+            "score"	INTEGER NOT NULL DEFAULT 0,
+            "vote_ratio"	INTEGER,
+            "subreddit"	TEXT NOT NULL,
+            "path"	TEXT,
+            "shuffle_key"	INTEGER
+        );
+        """
+    )
+    cur.execute(
+        """
+        INSERT INTO `posts_new`
+        SELECT `rowid`, `id`, `title`, `link`, `generated_md5`, `author`, `time`, `type`, `file_url`, `is_video`,
+            `nsfw`, `spoiler`, `score`, `vote_ratio`, `subreddit`, `path`, `shuffle_key`
+        FROM `posts`
+        """
+    )
+    cur.execute("DROP TABLE `posts`")
+    # the triggers on other tables refer to posts, which doesn't exist for a moment, so the schema isn't checked
+    cur.execute("PRAGMA legacy_alter_table = ON")
+    cur.execute("ALTER TABLE `posts_new` RENAME TO `posts`")
+    cur.execute("PRAGMA legacy_alter_table = OFF")
+    # dropping the table dropped its indexes and triggers too
+    for sql in schema:
+        cur.execute(sql)
+
+
+MIGRATIONS = [
+    _baseline,
+    _typed_posts,
+    _indexes,
+    _keyset_indexes,
+    _search_index,
+    _subreddit_stats,
+    _post_keys,
+]
+
+
+def _add_column(cur: sqlite3.Cursor, table: str, column: str, definition: str):
+    # for databases from before migrations, whose tables were changed in place
+    cur.execute(f"PRAGMA table_info(`{table}`)")
+    if column not in [col[1] for col in cur.fetchall()]:
+        cur.execute(f"ALTER TABLE `{table}` ADD COLUMN `{column}` {definition}")
+
+
+def version(connection: sqlite3.Connection) -> int:
+    """
+    Gets the schema version of a database.
+    :param connection: The database connection.
+    :return: The amount of migrations that were run on it.
+    """
+    connection.execute('CREATE TABLE IF NOT EXISTS `schema_version` ("version" INTEGER NOT NULL)')
+    row = connection.execute("SELECT MAX(`version`) FROM `schema_version`").fetchone()
+    return row[0] or 0
+
+
+def migrate(connection: sqlite3.Connection) -> int:
+    """
+    Runs the migrations a database doesn't have yet, each in its own transaction.
+    :param connection: The database connection.
+    :return: The amount of migrations that were run.
+    """
+    connection.commit()
+    current = version(connection)
+    if current > len(MIGRATIONS):
+        raise errors.SchemaTooNewError(current, len(MIGRATIONS))
+    cur = connection.cursor()
+    for number, migration in enumerate(MIGRATIONS[current:], current + 1):
+        logger.info(f"Upgrading the database to version {number}: {migration.__doc__}")
+        cur.execute("BEGIN")
+        try:
+            migration(cur)
+            cur.execute("DELETE FROM `schema_version`")
+            cur.execute("INSERT INTO `schema_version` VALUES (?)", (number,))
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+    return len(MIGRATIONS) - current
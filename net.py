@@ -0,0 +1,239 @@
+# A single HTTP client shared by everything that talks to the network, so that connections to reddit.com,
+# i.redd.it, v.redd.it and friends are kept alive and reused instead of being opened for every request.
+# Every request also goes through a per-host limiter, which follows reddit's X-Ratelimit-* headers and backs off when
+# a server answers with 429 Too Many Requests, and every downloaded byte goes through a shared bandwidth cap.
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import constants
+
+_session = None
+_lock = threading.Lock()
+_limiters = {}
+_bandwidth = None
+# how many processes share --max-bandwidth (see main.download_sharded)
+bandwidth_shares = 1
+
+# the fastest a host that rate limited us without telling us its budget is allowed to go again
+BACKOFF_RATE = 1.0
+# once a host that rate limited us is allowed this many requests per second again, it is no longer limited
+RECOVERED_RATE = 50.0
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket. Tokens are refilled at a constant rate, up to the capacity of the bucket.
+    """
+    def __init__(self, rate: float or None, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate: float or None):
+        with self.lock:
+            self._refill()
+            self.rate = rate
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount: float = 1.0):
+        """
+        Blocks until there are enough tokens in the bucket, then takes them.
+        Taking more than the capacity is allowed, the bucket just goes into debt.
+        :param amount: The amount of tokens to take.
+        """
+        while True:
+            with self.lock:
+                if self.rate is None:
+                    return  # unlimited
+                self._refill()
+                if self.tokens >= min(amount, self.capacity):
+                    self.tokens -= amount
+                    return
+                wait = (min(amount, self.capacity) - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostLimiter:
+    """
+    Keeps track of the request budget of a single host.
+    """
+    def __init__(self, host: str, rate: float or None):
+        self.host = host
+        self.default_rate = rate
+        self.bucket = TokenBucket(rate, max(rate or 1, 1))
+        self.blocked_until = 0.0
+        self.backed_off = False
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                wait = self.blocked_until - time.monotonic()
+            if wait <= 0:
+                break
+            time.sleep(wait)
+        self.bucket.acquire()
+
+    def update(self, response: requests.Response):
+        """
+        Adjusts the budget to the X-Ratelimit-* headers of a response, if it has them.
+        :param response: The response.
+        """
+        remaining = response.headers.get("X-Ratelimit-Remaining")
+        reset = response.headers.get("X-Ratelimit-Reset")
+        if remaining is None or reset is None:
+            if self.backed_off and response.status_code != 429:
+                self._recover()
+            return
+        try:
+            remaining = float(remaining)
+            reset = max(float(reset), 1.0)
+        except ValueError:
+            return
+        if remaining < 1:
+            # nothing left in this window, so wait for the next one
+            with self.lock:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + reset)
+        else:
+            # spread what's left evenly over the rest of the window
+            rate = remaining / reset
+            self.bucket.set_rate(min(rate, self.default_rate) if self.default_rate else rate)
+
+    def backoff(self, attempt: int, response: requests.Response) -> float:
+        """
+        Pauses all requests to the host after it rate limited us.
+        :param attempt: How many times the request has been retried already.
+        :param response: The 429 response.
+        :return: The amount of seconds requests are paused for.
+        """
+        retry_after = response.headers.get("Retry-After")
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            # exponential backoff with jitter, so the workers don't all retry at the same moment
+            delay = min(constants.args.max_backoff, 2 ** attempt) * random.uniform(0.5, 1.5)
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        if "X-Ratelimit-Remaining" not in response.headers:
+            # the host didn't tell us its budget, so halve our rate and slowly work back up from there
+            rate = self.bucket.rate
+            self.bucket.set_rate(max(rate / 2, 0.1) if rate else BACKOFF_RATE)
+            self.backed_off = True
+        return delay
+
+    def _recover(self):
+        # each successful request adds about one request per second, every second
+        rate = self.bucket.rate + 1 / self.bucket.rate
+        limit = self.default_rate or RECOVERED_RATE
+        if rate >= limit:
+            self.backed_off = False
+            self.bucket.set_rate(self.default_rate)
+        else:
+            self.bucket.set_rate(rate)
+
+
+def limiter(host: str) -> HostLimiter:
+    """
+    Gets the limiter of a host, creating it the first time the host is used.
+    :param host: The host name.
+    :return: The limiter of the host.
+    """
+    with _lock:
+        if host not in _limiters:
+            _limiters[host] = HostLimiter(host, constants.args.rate_limit or None)
+        return _limiters[host]
+
+
+def throttle(amount: int):
+    """
+    Waits until some bytes can be downloaded without going over --max-bandwidth.
+    :param amount: The amount of bytes that were received.
+    """
+    global _bandwidth
+    if not constants.args.max_bandwidth:
+        return
+    if _bandwidth is None:
+        with _lock:
+            if _bandwidth is None:
+                rate = constants.args.max_bandwidth / bandwidth_shares
+                _bandwidth = TokenBucket(rate, rate)  # allow bursts of up to a second
+    _bandwidth.acquire(amount)
+
+
+def session() -> requests.Session:
+    """
+    Gets the shared session, creating it the first time it is needed.
+    :return: The shared session.
+    """
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = _create_session()
+    return _session
+
+
+def _create_session() -> requests.Session:
+    args = constants.args
+    retries = Retry(
+        total=args.retries,
+        backoff_factor=0.5,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=("GET", "HEAD"),
+        # 429s are left to request(), so the limiter of the host sees them and slows down
+        respect_retry_after_header=False,
+    )
+    # one pool per host, each with enough connections for every download worker
+    adapter = HTTPAdapter(
+        pool_connections=args.pool_hosts,
+        pool_maxsize=max(args.pool_size, args.workers),
+        max_retries=retries,
+    )
+    s = requests.Session()
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    s.headers.update(constants.USERAGENT)
+    return s
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Sends a request with the shared session, waiting for the budget of the host and retrying if it rate limits us.
+    :param method: The HTTP method.
+    :param url: The URL to request.
+    :return: The response.
+    """
+    kwargs.setdefault("timeout", constants.args.timeout)
+    host = limiter(urlparse(url).netloc)
+    attempt = 0
+    while True:
+        host.acquire()
+        r = session().request(method, url, **kwargs)
+        host.update(r)
+        if r.status_code != 429 or attempt >= constants.args.retries:
+            return r
+        r.close()
+        delay = host.backoff(attempt, r)
+        constants.logger.warn(f"Rate limited by {host.host}, retrying in {delay:.1f}s")
+        attempt += 1
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def head(url: str, **kwargs) -> requests.Response:
+    return request("HEAD", url, **kwargs)
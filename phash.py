@@ -0,0 +1,98 @@
+# Perceptual hashes of downloaded images, for finding reposts that were recompressed or resized and so don't have the
+# same content hash as the original.
+import threading
+
+import numpy as np
+from PIL import Image
+
+from utils import load_image
+
+HASH_SIZE = 8
+
+# the amount of set bits in every possible byte
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def dhash(image: Image.Image) -> int:
+    """
+    Computes the difference hash of an image: whether each pixel of a tiny grayscale version is brighter than the one
+    next to it. Similar images have hashes that only differ in a few bits.
+    :param image: The image.
+    :return: The 64-bit hash.
+    """
+    small = np.asarray(image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS), dtype=np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def file_hash(filepath: str) -> int or None:
+    """
+    Computes the difference hash of an image, or the first frame of a video.
+    :param filepath: The path of the media file.
+    :return: The 64-bit hash, or None if the file couldn't be opened.
+    """
+    im = load_image(filepath)
+    if isinstance(im, int):
+        return None
+    return dhash(im)
+
+
+def to_signed(h: int) -> int:
+    # sqlite integers are signed
+    return h - (1 << 64) if h >= 1 << 63 else h
+
+
+def to_unsigned(h: int) -> int:
+    return h + (1 << 64) if h < 0 else h
+
+
+class PHashIndex:
+    """
+    An in-memory index of perceptual hashes, searched by Hamming distance with vectorized NumPy operations.
+    """
+    def __init__(self):
+        self.hashes = np.zeros(1024, dtype=np.uint64)
+        self.ids = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, cur) -> "PHashIndex":
+        """
+        Builds an index of every hash in the database.
+        :param cur: The database cursor.
+        :return: The index.
+        """
+        index = cls()
+        cur.execute("SELECT `post_id`, `hash` FROM `phashes`")
+        rows = cur.fetchall()
+        index.ids = [row[0] for row in rows]
+        index.hashes = np.array([to_unsigned(row[1]) for row in rows] or [0], dtype=np.uint64)
+        return index
+
+    def add(self, post_id: str, h: int):
+        with self.lock:
+            if len(self.ids) == len(self.hashes):
+                # grow by doubling, so adding stays cheap
+                self.hashes = np.concatenate([self.hashes, np.zeros(max(len(self.hashes), 1024), dtype=np.uint64)])
+            self.hashes[len(self.ids)] = h
+            self.ids.append(post_id)
+
+    def search(self, h: int, max_distance: int) -> list[tuple[str, int]]:
+        """
+        Finds the hashes that are close to a hash.
+        :param h: The hash to search for.
+        :param max_distance: The most bits the hashes can differ in.
+        :return: The post ids and distances of the matches, closest first.
+        """
+        with self.lock:
+            count = len(self.ids)
+            if count == 0:
+                return []
+            xor = np.bitwise_xor(self.hashes[:count], np.uint64(h))
+            distances = POPCOUNT[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+            matches = np.nonzero(distances <= max_distance)[0]
+            matches = matches[np.argsort(distances[matches], kind="stable")]
+            return [(self.ids[i], int(distances[i])) for i in matches]
@@ -0,0 +1,126 @@
+# Schedules media downloads by size, so one big video doesn't hold up dozens of small images behind it.
+# The size of every video is checked first (with a HEAD request, unless it is already known), then small files are
+# downloaded smallest first by the normal workers, and large ones on a lane of their own with fewer workers. Images
+# are never checked, since they are almost never large and the check would double the requests for them.
+import itertools
+import queue
+import threading
+from concurrent.futures import Future
+
+import requests
+
+import constants
+import log
+import net
+
+# size checks go before every download
+PROBE = -1
+STOP = float("inf")
+
+
+class Lane:
+    """
+    A group of worker threads that take jobs from a priority queue, lowest priority first.
+    """
+    def __init__(self, name: str, workers: int):
+        self.jobs = queue.PriorityQueue()
+        self.order = itertools.count()  # keeps jobs with the same priority first in, first out
+        self.threads = [
+            threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True) for i in range(max(workers, 1))
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, priority: float, func):
+        self.jobs.put((priority, next(self.order), func))
+
+    def _work(self):
+        while True:
+            _, _, func = self.jobs.get()
+            if func is None:
+                return
+            func()
+
+    def shutdown(self):
+        # the stop jobs sort after everything else, so the queue is drained first
+        for _ in self.threads:
+            self.put(STOP, None)
+        for thread in self.threads:
+            thread.join()
+
+
+def probe_size(url: str) -> int or None:
+    """
+    Asks the server how big a file is, without downloading it.
+    :param url: The URL of the file.
+    :return: The size in bytes, or None if the server didn't say.
+    """
+    try:
+        with log.stats.timer("probe"):
+            r = net.head(url, allow_redirects=True)
+    except requests.exceptions.RequestException:
+        return None
+    length = r.headers.get("content-length")
+    return int(length) if r.ok and length and length.isdigit() else None
+
+
+class Scheduler:
+    """
+    Runs downloads like a ThreadPoolExecutor, but smallest file first, with large files on a separate lane.
+    """
+    def __init__(self, workers: int = None, large_workers: int = None, threshold: int = None):
+        args = constants.args
+        self.threshold = args.large_file_threshold if threshold is None else threshold
+        self.small = Lane("download", workers or args.workers)
+        self.large = Lane("download-large", large_workers or args.large_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def submit(self, fn, *args, url: str = None, size: int = None, video: bool = False) -> Future:
+        """
+        Schedules a download.
+        :param fn: The function that downloads the file.
+        :param args: The arguments of the function.
+        :param url: The URL of the file, to check its size if it is a video.
+        :param size: The size of the file, if it is already known.
+        :param video: Whether the file is a video. Only videos have their size checked, and one whose size is still
+        unknown goes on the large lane.
+        :return: The future of the result of the function.
+        """
+        future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+        def schedule(file_size):
+            if file_size is None:
+                # after the small files we know about
+                lane = self.large if video else self.small
+                lane.put(self.threshold, run)
+            else:
+                lane = self.large if file_size >= self.threshold else self.small
+                lane.put(file_size, run)
+            if lane is self.large:
+                log.stats.add("large_files")
+
+        if not self.threshold:
+            self.small.put(0, run)  # no scheduling, so listing order
+        elif size is not None or url is None or not video:
+            schedule(size)
+        else:
+            self.small.put(PROBE, lambda: schedule(probe_size(url)))
+        return future
+
+    def shutdown(self):
+        # the small lane goes first, since its size checks can still put files on the large lane
+        self.small.shutdown()
+        self.large.shutdown()
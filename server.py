@@ -1,15 +1,21 @@
 import io
+import random
 from os.path import exists
 
 import magic
 import PIL
 import flask
-import sqlite3
-from constants import DATA_DIR
-from utils import truefalse, get_icon, media_thumbnail
+from connections import ConnectionPool
+from constants import DATA_DIR, PHASH_DISTANCE
+from database import POST_COLUMNS, search_posts
+from utils import truefalse, get_icon
+import thumbnails
+from phash import PHashIndex, to_unsigned
 from PIL import Image, ImageFilter
 
 app = flask.Flask(__name__, template_folder="www")
+# sqlite connections can't be shared between threads, so every request checks one out of the pool
+_pool = ConnectionPool(DATA_DIR + "data.db")
 
 
 # if you want to add something to the script, please throw the correct HTTP error code if something goes wrong:
@@ -86,58 +92,145 @@ def icon(subreddit):
         return "", 404
 
 
+def post_json(_post):
+    return {
+        "id": _post[0],
+        "title": _post[1],
+        "permalink": _post[2],
+        "md5": _post[3],
+        "author": _post[4],
+        "time_created": _post[5],
+        "type": _post[6],
+        "url": _post[7],
+        "is_video": truefalse(_post[8]),
+        "is_nsfw": truefalse(_post[9]),
+        "is_spoiler": truefalse(_post[10]),
+        "score": _post[11],
+        "vote_ratio": _post[12],
+        "subreddit": _post[13]
+    }
+
+
 @app.route("/api/get_posts", methods=["GET"])
 def get_posts():
-    with sqlite3.connect(DATA_DIR + "/data.db") as conn:  # we must connect every page since sqlite3 isn't thread-safe
+    """
+    Lists posts, newest first (or highest score first with order=score), a page at a time.
+    Pages are chained with the X-Next-Cursor header of the response, passed back as before=, so every page is found
+    through the index no matter how deep it is. offset= still works, but gets slower the further in it is.
+    With random=, a random sample of posts is returned instead.
+    """
+    with _pool.connection() as conn:
         cur = conn.cursor()
 
-    args = flask.request.args
-    if "offset" in args:
-        offset = int(args["offset"])
-    else:
-        offset = 0
-    if "limit" in args:
-        limit = int(args["limit"])
-    else:
-        limit = 25
-    if "random" in args:
-        print("random in args")
-        order = "RANDOM()"
-    else:
-        order = "`time` DESC"
-    if "subreddit" in args:
+        args = flask.request.args
+        limit = int(args.get("limit", 25))
+        where = []
+        params = []
+        if "subreddit" in args:
+            where.append("`subreddit` = ?")
+            params.append(args["subreddit"])
+        if "random" in args:
+            return flask.jsonify([post_json(_post) for _post in _random_posts(cur, where, params, limit)])
+
+        column = "score" if args.get("order") == "score" else "time"
+        if "before" in args:
+            try:
+                value, post_id = args["before"].split(":", 1)
+                params += [int(value), post_id]
+            except ValueError:
+                return "", 400
+            where.append(f"(`{column}`, `id`) < (?, ?)")
+        query = f"SELECT {POST_COLUMNS} FROM `posts`"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += f" ORDER BY `{column}` DESC, `id` DESC LIMIT ?"
+        params.append(limit)
+        if "offset" in args and "before" not in args:
+            query += " OFFSET ?"
+            params.append(int(args["offset"]))
+        cur.execute(query, params)
+        rows = cur.fetchall()
+
+        response = flask.jsonify([post_json(_post) for _post in rows])
+        if len(rows) == limit:
+            last = rows[-1]
+            response.headers["X-Next-Cursor"] = f"{last[11] if column == 'score' else last[5]}:{last[0]}"
+        return response
+
+
+def _random_posts(cur, where: list, params: list, limit: int) -> list:
+    # every post has a random shuffle key, so a sample is the posts with the keys right after a random one,
+    # which the index finds without sorting the whole table
+    start = random.randint(-2 ** 63, 2 ** 63 - 1)
+    rows = []
+    # wrap around to the lowest keys if there aren't enough above the start
+    for condition in ("`shuffle_key` >= ?", "`shuffle_key` < ?"):
         cur.execute(
-            "SELECT * FROM posts WHERE subreddit = ? ORDER BY %s LIMIT ? OFFSET ?" % order,
-            (
-                args["subreddit"],
-                limit,
-                offset
-            )
+            f"SELECT {POST_COLUMNS} FROM `posts` WHERE " + " AND ".join(where + [condition]) +
+            " ORDER BY `shuffle_key` LIMIT ?",
+            params + [start, limit - len(rows)]
         )
-    else:
-        cur.execute("SELECT * FROM `posts` ORDER BY %s LIMIT ? OFFSET ?" % order, (limit, offset))
-
-    post_list = []
-    posts = cur.fetchall()
-    for _post in posts:
-        post_list.append({
-            "id": _post[0],
-            "title": _post[1],
-            "permalink": _post[2],
-            "md5": _post[3],
-            "author": _post[4],
-            "time_created": _post[5],
-            "type": _post[6],
-            "url": _post[7],
-            "is_video": truefalse(_post[8]),
-            "is_nsfw": truefalse(_post[9]),
-            "is_spoiler": truefalse(_post[10]),
-            "score": _post[11],
-            "vote_ratio": _post[12],
-            "subreddit": _post[13]
-        })
-
-    return flask.jsonify(post_list)
+        rows += cur.fetchall()
+        if len(rows) >= limit:
+            break
+    return rows
+
+
+@app.route("/api/subreddits", methods=["GET"])
+def subreddits():
+    with _pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT `name`, `posts`, `media_bytes`, `newest`, `icon` FROM `subreddits` WHERE `posts` > 0 "
+            "ORDER BY `name`"
+        )
+        return flask.jsonify([
+            {"name": row[0], "posts": row[1], "media_bytes": row[2], "newest": row[3], "has_icon": row[4] == "present"}
+            for row in cur.fetchall()
+        ])
+
+
+@app.route("/api/search", methods=["GET"])
+def search():
+    args = flask.request.args
+    if not args.get("q"):
+        return "", 400
+    with _pool.connection() as conn:
+        rows = search_posts(
+            conn.cursor(), args["q"], args.get("subreddit"), int(args.get("limit", 25)), int(args.get("offset", 0))
+        )
+    return flask.jsonify([post_json(_post) for _post in rows])
+
+
+_phash_index = None
+
+
+@app.route("/api/similar/<post_id>", methods=["GET"])
+def similar(post_id):
+    global _phash_index
+    with _pool.connection() as conn:
+        cur = conn.cursor()
+
+        args = flask.request.args
+        distance = int(args.get("distance", PHASH_DISTANCE))
+        cur.execute("SELECT `hash` FROM `phashes` WHERE `post_id` = ?", (post_id,))
+        row = cur.fetchone()
+        if row is None:
+            return "", 404
+
+        # the index is only reloaded when images were added since it was built
+        cur.execute("SELECT COUNT(*) FROM `phashes`")
+        if _phash_index is None or len(_phash_index) != cur.fetchone()[0]:
+            _phash_index = PHashIndex.load(cur)
+
+        matches = [match for match in _phash_index.search(to_unsigned(row[0]), distance) if match[0] != post_id]
+        post_list = []
+        for match_id, match_distance in matches[:int(args.get("limit", 50))]:
+            cur.execute(f"SELECT {POST_COLUMNS} FROM `posts` WHERE `id` = ?", (match_id,))
+            _post = cur.fetchone()
+            if _post:
+                post_list.append(dict(post_json(_post), distance=match_distance))
+        return flask.jsonify(post_list)
 
 
 @app.route("/api/get_media/<subreddit>/<md5>", methods=["GET"])
@@ -171,12 +264,17 @@ def thumbnail(subreddit, md5):
         blur = True
     else:
         blur = False
-    resp = media_thumbnail(file, blur=blur, width=512, height=512)
+    resp = thumbnails.cache.get(file, blur=blur, width=thumbnails.GRID_SIZE, height=thumbnails.GRID_SIZE)
     if isinstance(resp, int):
         return "", resp
     return flask.Response(resp, mimetype="image/jpeg")
 
 
+@app.route("/api/thumbnail_cache", methods=["GET"])
+def thumbnail_cache():
+    return flask.jsonify(thumbnails.cache.stats())
+
+
 @app.route("/", methods=["GET"])
 def index():
     return flask.render_template("index.html")
@@ -189,16 +287,18 @@ def sub(subreddit):
 
 @app.route("/r/<subreddit>/<post_id>/", methods=["GET"])
 def post(subreddit, post_id):
-    with sqlite3.connect(DATA_DIR + "/data.db") as conn:
+    with _pool.connection() as conn:
         cur = conn.cursor()
-    cur.execute("SELECT * FROM `posts` WHERE `subreddit` = ? AND `id` = ? LIMIT 1", (subreddit, post_id))
-    res = cur.fetchall()
-    md5 = res[0][3]
-    is_video = res[0][8]
-    if not is_video:
-        return "<img src='/api/get_media/" + subreddit + "/" + md5 + "'></img>"
-    else:
-        return "<video src='/api/get_media/" + subreddit + "/" + md5 + "' controls></video>"
+        cur.execute(
+            f"SELECT {POST_COLUMNS} FROM `posts` WHERE `subreddit` = ? AND `id` = ? LIMIT 1", (subreddit, post_id)
+        )
+        res = cur.fetchall()
+        md5 = res[0][3]
+        is_video = res[0][8]
+        if not is_video:
+            return "<img src='/api/get_media/" + subreddit + "/" + md5 + "'></img>"
+        else:
+            return "<video src='/api/get_media/" + subreddit + "/" + md5 + "' controls></video>"
 
 
 run = app.run
@@ -0,0 +1,99 @@
+# A content-addressed store for media files. Every file is kept once in objects/, named after the sha256 of its
+# content, and the media/<subreddit>/<post id> paths are hard links to it. Reposts of the same file in different
+# subreddits (or the same one) only take up space once.
+import hashlib
+import os
+import shutil
+from os.path import exists
+
+import constants
+import log
+import net
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def object_path(digest: str) -> str:
+    return constants.DATA_DIR + f"objects/{digest[:2]}/{digest}"
+
+
+def file_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def link(source: str, target: str):
+    """
+    Makes target the same file as source, with a hard link if the filesystem supports it, otherwise with a copy.
+    """
+    if exists(target) and os.path.samefile(source, target):
+        return  # already linked, and replacing a link with the same file would leave the temporary one behind
+    tmp = target + ".link"
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copyfile(source, tmp)
+    os.replace(tmp, target)
+
+
+def release(digest: str):
+    """
+    Removes a file from the store if no media path links to it anymore.
+    :param digest: The hash of the file.
+    """
+    obj = object_path(digest)
+    try:
+        if os.stat(obj).st_nlink <= 1:
+            os.remove(obj)
+    except FileNotFoundError:
+        pass
+
+
+def add(path: str) -> tuple[str, int]:
+    """
+    Adds a file to the store. If the store already has a file with the same content, the file is replaced by a link
+    to that one.
+    :param path: The path of the file.
+    :return: The hash and size of the file.
+    """
+    digest = file_hash(path)
+    obj = object_path(digest)
+    os.makedirs(os.path.dirname(obj), exist_ok=True)
+    try:
+        os.link(path, obj)
+    except FileExistsError:
+        if not os.path.samefile(path, obj):
+            link(obj, path)
+            log.stats.add("deduplicated")
+    except OSError:
+        # no hard links on this filesystem, so keep a copy in the store
+        if not exists(obj):
+            shutil.copyfile(path, obj)
+    return digest, os.path.getsize(path)
+
+
+def fetch(url: str, target_file: str, message: str, quiet: bool = False, known: tuple = None) -> tuple[str, int]:
+    """
+    Downloads a file into the store, unless the store already has it.
+    :param url: The URL to download.
+    :param target_file: The path the file should be at.
+    :param message: The message to print before the download starts.
+    :param quiet: Whether to hide the progress bar.
+    :param known: The hash and size of the file the URL pointed to last time, if it was downloaded before.
+    :return: The hash and size of the file.
+    """
+    if known is not None and not exists(target_file):
+        digest, size = known
+        obj = object_path(digest)
+        if exists(obj) and os.path.getsize(obj) == size:
+            # make sure the URL still points to the same file before skipping it, which costs no body bytes
+            length = net.head(url, allow_redirects=True).headers.get("content-length")
+            if length is None or int(length) == size:
+                link(obj, target_file)
+                log.stats.add("deduplicated")
+                return digest, size
+    log.progress.request_progress(url, target_file, message, quiet)
+    return add(target_file)
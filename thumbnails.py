@@ -0,0 +1,140 @@
+# An on-disk cache of thumbnails, so the web UI doesn't decode, resize and encode the whole image (or open the video)
+# every time it shows one. Thumbnails are named after the source file, its modification time, the size and the blur,
+# so a file that changes gets a new thumbnail. When the cache grows over --thumbnail-cache-size, the least recently
+# used thumbnails are removed.
+import hashlib
+import os
+import threading
+
+import constants
+from utils import image_thumbnail, load_image, media_thumbnail
+
+# eviction goes a bit below the cap, so it doesn't run again on the next thumbnail
+EVICT_TO = 0.9
+# the size of the thumbnails in the grid of the web UI
+GRID_SIZE = 512
+# the sizes that are made ahead of time with --pregenerate-thumbnails, each one blurred and not
+STANDARD_SIZES = (GRID_SIZE,)
+
+
+class ThumbnailCache:
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = None  # bytes in the cache, counted the first time it is needed
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def path(self, filepath: str, width: int, height: int, blur: bool) -> str or None:
+        """
+        Gets where the thumbnail of a file is kept.
+        :return: The path, or None if the file doesn't exist.
+        """
+        try:
+            mtime = os.stat(filepath).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        key = hashlib.sha1(f"{os.path.abspath(filepath)}|{mtime}|{width}x{height}|{int(blur)}".encode()).hexdigest()
+        return os.path.join(self.directory, key[:2], key + ".jpg")
+
+    def get(self, filepath: str, width: int = 256, height: int = 256, blur: bool = False) -> bytes or int:
+        """
+        Gets the thumbnail of an image or video, making it if it isn't in the cache.
+        :param filepath: The path of the media file.
+        :param width: The most width of the thumbnail.
+        :param height: The most height of the thumbnail.
+        :param blur: Whether to blur the thumbnail.
+        :return: The thumbnail as JPEG, or an HTTP error code if the file couldn't be opened.
+        """
+        path = self.path(filepath, width, height, blur)
+        if path is None:
+            return 404
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # the modification time is when it was last used
+            with self.lock:
+                self.hits += 1
+            return data
+        except FileNotFoundError:
+            pass
+
+        with self.lock:
+            self.misses += 1
+        data = media_thumbnail(filepath, width, height, blur)
+        if not isinstance(data, int):
+            self.put(path, data)
+        return data
+
+    def put(self, path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written under a temporary name, so no one reads a half-written thumbnail
+        tmp = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self.lock:
+            if self.size is not None:
+                self.size += len(data)
+        if self.max_size and (self.size is None or self.size > self.max_size):
+            self.evict()
+
+    def evict(self):
+        """
+        Counts the size of the cache, and removes the least recently used thumbnails if it is over the cap.
+        """
+        with self.lock:
+            files = []
+            for root, _, names in os.walk(self.directory):
+                for name in names:
+                    if not name.endswith(".jpg"):
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue  # evicted by another process
+                    files.append((st.st_mtime, st.st_size, path))
+            total = sum(file[1] for file in files)
+            if self.max_size and total > self.max_size:
+                files.sort()
+                for _, size, path in files:
+                    if total <= self.max_size * EVICT_TO:
+                        break
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+            self.size = total
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": self.size, "max_size": self.max_size}
+
+
+def pregenerate(filepath: str) -> int:
+    """
+    Makes the standard thumbnails of a file that aren't in the cache yet, decoding the file only once.
+    Runs in the thumbnail worker processes of a download.
+    :param filepath: The path of the media file.
+    :return: The amount of thumbnails that were made.
+    """
+    im = None
+    made = 0
+    for size in STANDARD_SIZES:
+        for blur in (False, True):
+            path = cache.path(filepath, size, size, blur)
+            if path is None or os.path.exists(path):
+                continue
+            if im is None:
+                im = load_image(filepath)
+                if isinstance(im, int):
+                    return made
+            cache.put(path, image_thumbnail(im, size, size, blur))
+            made += 1
+    return made
+
+
+cache = ThumbnailCache(os.path.join(constants.DATA_DIR, "thumbnails"), constants.args.thumbnail_cache_size)
@@ -1,19 +1,105 @@
-import requests
+import codecs
 import re
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import urljoin
+
+import log
 import media_handler
+import net
+
+PAGE_CHUNK_SIZE = 8 * 1024
+# how far back a match can start in the text that was already searched (longer than any media URL)
+PAGE_OVERLAP = 512
 
 
 def get_file_url(file_id: str) -> str:
     return "".join(
         re.findall(
             r"(https://cdn-\d*.anonfiles.com/)(\w{10})(/[\w-]{19}/)(.*)\"",
-            requests.get("https://www.anonfiles.com/" + file_id).text
+            net.get("https://www.anonfiles.com/" + file_id).text
         )[0]
     )
 
 
+def run_handler(url: str, handler) -> str or None:
+    """
+    Streams a page through a handler, and stops downloading it as soon as the handler finds the media URL.
+    The media URL is usually in the head of the page, so most of the page is never downloaded.
+    :param url: The URL of the page.
+    :param handler: The handler, which takes (part of) the page and returns the media URL or None.
+    :return: The media URL, or None if the handler didn't find it anywhere in the page.
+    """
+    with net.get(url, stream=True) as r:
+        # an error page has no media either, but that isn't something to remember
+        r.raise_for_status()
+        decoder = codecs.getincrementaldecoder(r.encoding or "utf-8")(errors="replace")
+        text = ""
+        for chunk in r.iter_content(chunk_size=PAGE_CHUNK_SIZE):
+            log.stats.add("page_bytes", len(chunk))
+            # only search the new text, plus enough of the old text for a match that started before it
+            text = text[-PAGE_OVERLAP:] + decoder.decode(chunk)
+            found = handler(text)
+            if found is not None:
+                return found
+        return handler(text[-PAGE_OVERLAP:] + decoder.decode(b"", final=True))
+
+
 def get_handler(url: str) -> str or None:
     for key, value in media_handler.URLS.items():
         if key.match(url):
             return value
     return None
+
+
+def pick_rendition(manifest: str, max_height: int = 0, max_bitrate: int = 0) -> tuple[str, int, int] or None:
+    """
+    Picks the best video rendition of a DASH manifest that fits within the limits.
+    :param manifest: The MPD document.
+    :param max_height: The highest video height to allow (0 for any).
+    :param max_bitrate: The highest bitrate to allow, in kbps (0 for any).
+    :return: The relative URL, height and bitrate (in kbps) of the rendition, or the smallest one if none fit, or None
+    if the manifest has no video.
+    """
+    renditions = []
+    for adaptation in ElementTree.fromstring(manifest).iter():
+        if not adaptation.tag.endswith("AdaptationSet"):
+            continue
+        if "audio" in adaptation.get("contentType", "") + adaptation.get("mimeType", ""):
+            continue
+        for rep in adaptation:
+            if not rep.tag.endswith("Representation"):
+                continue
+            base = next((e.text for e in rep if e.tag.endswith("BaseURL")), None)
+            if base and rep.get("height"):
+                renditions.append((base.strip(), int(rep.get("height")), int(rep.get("bandwidth", 0)) // 1000))
+    if not renditions:
+        return None
+    fitting = [
+        r for r in renditions
+        if (not max_height or r[1] <= max_height) and (not max_bitrate or r[2] <= max_bitrate)
+    ]
+    if not fitting:
+        return min(renditions, key=lambda r: (r[1], r[2]))
+    return max(fitting, key=lambda r: (r[1], r[2]))
+
+
+def get_video_url(video: dict, max_height: int = 0, max_bitrate: int = 0) -> str:
+    """
+    Gets the URL of the rendition of a reddit video to download. The fallback URL is the best rendition, so a smaller
+    one is looked up in the DASH manifest if that one is over the limits.
+    :param video: The reddit_video dict of a post.
+    :param max_height: The highest video height to allow (0 for any).
+    :param max_bitrate: The highest bitrate to allow, in kbps (0 for any).
+    :return: The URL of the video.
+    """
+    fallback = video["fallback_url"]
+    height = video.get("height") or 0
+    bitrate = video.get("bitrate_kbps") or 0
+    if (not max_height or 0 < height <= max_height) and (not max_bitrate or 0 < bitrate <= max_bitrate):
+        return fallback
+    if not video.get("dash_url"):
+        return fallback
+    rendition = pick_rendition(net.get(video["dash_url"]).text, max_height or height, max_bitrate)
+    if rendition is None:
+        return fallback
+    return urljoin(video["dash_url"], rendition[0])
@@ -8,9 +8,11 @@ from html import unescape
 
 import PIL
 from PIL import Image, ImageFilter
-import requests
 import termcolor as tc
 import constants
+import migrations
+import net
+import store
 from constants import logger, cur, db
 import cv2
 
@@ -94,15 +96,23 @@ def sync_files(subreddit: str):
     if not os.path.exists(constants.DATA_DIR + f"media/{subreddit}"):
         os.mkdir(constants.DATA_DIR + f"media/{subreddit}")
 
-    cur.execute('SELECT `file_url`, `path` FROM `%s`' % subreddit)
+    cur.execute('SELECT `id`, `file_url`, `path` FROM `posts` WHERE `subreddit` = ?', (subreddit,))
     for row in cur.fetchall():
-        if not exists(row[1]):
-            with open(row[1], 'wb') as file:
-                file.write(requests.get(row[0]).content)
-                logger.info("Downloaded %s to %s" % (row[0], row[1]))
-
-
-def setup():
+        if not exists(row[2]):
+            # resumes from the .part file if an earlier download was interrupted
+            digest, size = store.fetch(row[1], row[2], "Downloading %s to %s" % (row[1], row[2]), True)
+            # an upsert rather than a replace, so the triggers that count the media bytes see the old size
+            cur.execute(
+                "INSERT INTO `downloads` VALUES (?, 'complete', ?, ?) ON CONFLICT (`post_id`) DO UPDATE SET "
+                "`state` = excluded.`state`, `size` = excluded.`size`, `hash` = excluded.`hash`",
+                (row[0], size, digest)
+            )
+            cur.execute("INSERT OR IGNORE INTO `blobs` VALUES (?, ?)", (digest, size))
+            db.commit()
+            logger.info("Downloaded %s to %s" % (row[1], row[2]))
+
+
+def setup(tools: bool = True):
     # create the data directory if it doesn't exist
     if not exists(constants.DATA_DIR):
         logger.debug("Creating data directory")
@@ -118,22 +128,27 @@ def setup():
         logger.debug("Creating media directory")
         os.mkdir(constants.DATA_DIR + "media")
 
+    # the media store, which the files in the media directory are linked to
+    if not exists(constants.DATA_DIR + "objects"):
+        logger.debug("Creating objects directory")
+        os.mkdir(constants.DATA_DIR + "objects")
+
     # download terminal video player if it hasn't been downloaded yet
-    if not exists(constants.DATA_DIR + "tvp"):
+    if tools and not exists(constants.DATA_DIR + "tvp"):
         logger.debug("Downloading tvp")
         with open(constants.DATA_DIR + "tvp", "wb") as f:
-            f.write(requests.get(constants.TVP_FILE_LINUX).content)
+            f.write(net.get(constants.TVP_FILE_LINUX).content)
             st = os.stat(constants.DATA_DIR + "tvp")
             # chmod the file so that it can be executed (doesn't do it by default)
             os.chmod(constants.DATA_DIR + "tvp", st.st_mode | stat.S_IEXEC)
 
     # download ffplay for linux or windows if it hasn't been downloaded yet
-    if not (exists(constants.DATA_DIR + "ffplay") or exists(constants.DATA_DIR + "ffplay.exe")):
+    if tools and not (exists(constants.DATA_DIR + "ffplay") or exists(constants.DATA_DIR + "ffplay.exe")):
         if constants.PLATFORM == 'linux':
             logger.debug("Downloading ffplay")
             with open(constants.DATA_DIR + "ffplay", "wb") as f:
                 # linux
-                resp = requests.get(constants.FFPLAY_FILE_LINUX)
+                resp = net.get(constants.FFPLAY_FILE_LINUX)
                 if resp.status_code == 200:
                     f.write(resp.content)
                     st = os.stat(constants.DATA_DIR + "ffplay")
@@ -146,36 +161,15 @@ def setup():
             logger.debug("Downloading ffplay")
             with open(constants.DATA_DIR + "ffplay.exe", "wb") as f:
                 # windows
-                resp = requests.get(constants.FFPLAY_FILE_WIN)
+                resp = net.get(constants.FFPLAY_FILE_WIN)
                 if resp.status_code == 200:
                     # make sure the download worked, in case anonfile is down or something
                     f.write(resp.content)
                 else:
                     logger.error("Failed to download ffplay. Video playback will not function.")
 
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS `posts` (
-            "id"	TEXT UNIQUE,
-            "title"	TEXT,
-            "link"	TEXT,
-            "generated_md5"	TEXT,
-            "author"	TEXT,
-            "time"	INT,
-            "type"	TEXT,
-            "file_url"	TEXT,
-            "is_video"	INT,
-            "nsfw"	INT,
-            "spoiler"	INT,
-            "score"	INT,
-            "vote_ratio"	INT,
-            "subreddit"	TEXT,
-            "path"	TEXT
-        );
-        """
-    )
-
-    db.commit()
+    # create or upgrade the tables
+    migrations.migrate(db)
 
 
 def truefalse(s):
@@ -193,16 +187,17 @@ def get_icon(subreddit):
         else:
             return None
     else:
+        r = net.get(constants.REDDIT_URL + "/r/" + subreddit + "/about.json")
+        if not r.ok:
+            return None  # rate limited or down, so don't remember that there is no icon, try again next time
         try:
             with open(file, "wb") as f:
-                data = requests.get(
-                    "https://www.reddit.com/r/" + subreddit + "/about.json", headers=constants.USERAGENT
-                ).json()["data"]
+                data = r.json()["data"]
                 if data["community_icon"]:
-                    f.write(requests.get(unescape(data["community_icon"]), headers=constants.USERAGENT).content)
+                    f.write(net.get(unescape(data["community_icon"])).content)
                     return file
                 elif data["icon_img"]:  # we use the icon_img as a fallback
-                    f.write(requests.get(unescape(data["icon_img"]), headers=constants.USERAGENT).content)
+                    f.write(net.get(unescape(data["icon_img"])).content)
                     return file
                 else:
                     return None
@@ -210,36 +205,43 @@ def get_icon(subreddit):
             return None
 
 
-def media_thumbnail(filepath, width=256, height=256, blur=False):
+def load_image(filepath):
+    """
+    Opens an image, or the first frame of a video.
+    :param filepath: The path of the media file.
+    :return: The image in RGB, or an HTTP error code if the file couldn't be opened.
+    """
     if not exists(filepath):
         return 404
     try:
-        im = Image.open(filepath).convert('RGB')
-        if blur:
-            im = im.filter(ImageFilter.GaussianBlur(radius=50))
-        im.thumbnail((width, height))
-        im_bytes = io.BytesIO()
-        im.save(im_bytes, format="JPEG")
-        im_bytes.seek(0)
-        return im_bytes.read()
+        return Image.open(filepath).convert('RGB')
     except (PIL.UnidentifiedImageError, ValueError):
         cap = cv2.VideoCapture(filepath)
-        if cap.isOpened():
-            ret, frame = cap.read()
-            if ret:
-                is_success, im_buf_arr = cv2.imencode(".jpg", frame)
-                if not is_success:
-                    return 500
-                byte_im = io.BytesIO(im_buf_arr.tobytes())
-                im = Image.open(byte_im).convert("RGB")
-                if blur:
-                    im = im.filter(ImageFilter.GaussianBlur(radius=50))
-                im.thumbnail((width, height))
-                im_bytes = io.BytesIO()
-                im.save(im_bytes, format="JPEG")
-                im_bytes.seek(0)
-                return im_bytes.read()
-            else:
-                return 500
-        else:
+        if not cap.isOpened():
             return 500
+        ret, frame = cap.read()
+        cap.release()
+        if not ret:
+            return 500
+        is_success, im_buf_arr = cv2.imencode(".jpg", frame)
+        if not is_success:
+            return 500
+        byte_im = io.BytesIO(im_buf_arr.tobytes())
+        return Image.open(byte_im).convert("RGB")
+
+
+def media_thumbnail(filepath, width=256, height=256, blur=False):
+    im = load_image(filepath)
+    if isinstance(im, int):
+        return im
+    return image_thumbnail(im, width, height, blur)
+
+
+def image_thumbnail(im, width=256, height=256, blur=False):
+    # works on a copy, so one decoded image can be used for several thumbnails
+    im = im.filter(ImageFilter.GaussianBlur(radius=50)) if blur else im.copy()
+    im.thumbnail((width, height))
+    im_bytes = io.BytesIO()
+    im.save(im_bytes, format="JPEG")
+    im_bytes.seek(0)
+    return im_bytes.read()